@@ -0,0 +1,160 @@
+#Single process event driven FPNA implementation
+from tissue import InputNode, OutputNode
+from stats import Counters
+from collections import deque
+import copy
+
+#------------------------------------------------------------------------------
+class ActorEngine():
+  '''
+  Runs every resource of a Brain as an actor in this process.  Each actor
+  has an in-memory mailbox in place of its dataQueue, and the engine's event
+  loop hands the oldest message of the next ready actor to its handle(), one
+  message per turn, until no mailbox has messages left.  Since the actors
+  run the resources' own handle() code and each mailbox is first in, first
+  out like a Queue, values are passed exactly as between the resource
+  processes, but there are no processes, pipes or locks, so a network of
+  tens of thousands of resources fits in one process.
+
+  The actors are copies of the Brain's resources, so the Brain itself can
+  still be run by its processes or by a scheduler.Scheduler.
+  '''
+  #----------------------------------------------------------------------------
+  def __init__(self, brain):
+    '''
+    (Brain)brain: The finished Brain to run.
+    '''
+    self.brain = brain
+    self.numOutputs = len(brain.outputList)
+    self.mailboxes = {} #ID: deque of messages for the actor
+    self.actors = {} #ID: the actor's copy of the resource
+    self.ready = deque() #IDs of the actors with messages, in turn order
+    self.results = {} #seq: output vector, for input vectors in flight
+    self.seqCount = 0
+
+    for R in brain.inputList + brain.LinkList + brain.ActList + brain.outputList:
+      actor = copy.copy(R)
+      if hasattr(R, 'outputList'):
+        actor.outputList = dict((ID, {'dataQueue': _Mailbox(self, ID),
+                                      'credit': None,
+                                      'credits': 0,
+                                      }) for ID in R.outputList)
+      if hasattr(R, 'inputList'):
+        actor.inputList = dict((ID, {'credit': None, 'pending': 0})
+                               for ID in R.inputList)
+      if hasattr(R, 'partial'):
+        actor.partial = {}
+      actor.counters = Counters()
+      actor.trace = None
+      if isinstance(R, InputNode):
+        actor.credit = None
+        actor.pending = 0
+      if isinstance(R, OutputNode):
+        actor.brainDataQueue = _Results(self)
+      self.actors[R.ID] = actor
+      self.mailboxes[R.ID] = deque()
+    return
+
+  #----------------------------------------------------------------------------
+  def activate(self, X):
+    '''
+    (List of tuples of floats)X: The input vector, as for Brain.activate().
+    Returns the output vector.
+    '''
+    return self.collect(self.submit(X))
+
+  #----------------------------------------------------------------------------
+  def submit(self, X):
+    '''
+    Posts the input vector X (as for activate()) to the InputNodes and
+    returns its sequence number for collect().  Nothing runs until collect()
+    is called, so several input vectors can be posted first and go through
+    the network together.
+    '''
+    assert isinstance(X, list)
+    assert len(X) == len(self.brain.inputList)
+    seq = self.seqCount
+    self.seqCount += 1
+    self.results[seq] = [None]*self.numOutputs
+    for node, x in zip(self.brain.inputList, X):
+      self.post(node.ID, (x, seq))
+    return seq
+
+  #----------------------------------------------------------------------------
+  def collect(self, seq):
+    '''
+    Runs the actors until every mailbox is empty, and returns the output
+    vector of the input vector with sequence number seq.  Raises a
+    RuntimeError if an OutputNode did not fire for it.
+    '''
+    self.run()
+    y = self.results.pop(seq)
+    if None in y:
+      raise RuntimeError('OutputNode %s did not fire' %
+                         self.brain.outputList[y.index(None)])
+    return y
+
+  #----------------------------------------------------------------------------
+  def post(self, ID, item):
+    '''
+    Puts item in the mailbox of the actor ID, and makes the actor ready if
+    its mailbox was empty.
+    '''
+    mailbox = self.mailboxes[ID]
+    mailbox.append(item)
+    if len(mailbox) == 1:
+      self.ready.append(ID)
+    return
+
+  #----------------------------------------------------------------------------
+  def run(self):
+    '''
+    The event loop.  Each turn the next ready actor handles the oldest
+    message in its mailbox, and goes to the back of the line if it has more.
+    Returns when no actor is ready.
+    '''
+    ready = self.ready
+    while ready:
+      ID = ready.popleft()
+      mailbox = self.mailboxes[ID]
+      #The message stays in the mailbox while it is handled, so a post to
+      #this actor meanwhile does not make it ready a second time
+      self.actors[ID].handle(mailbox[0])
+      mailbox.popleft()
+      if mailbox:
+        ready.append(ID)
+    return
+
+#PRIVATE**********************************************************************
+#------------------------------------------------------------------------------
+class _Mailbox():
+  '''
+  Stands in for the dataQueue of the resource ID in an actor: put() posts to
+  the actor's mailbox.
+  '''
+  def __init__(self, engine, ID):
+    self.engine = engine
+    self.ID = ID
+    return
+
+  def put(self, item):
+    self.engine.post(self.ID, item)
+    return
+
+#------------------------------------------------------------------------------
+class _Results():
+  '''
+  Stands in for the Brain's dataQueue in an OutputNode actor: put() stores
+  the (y0, index, seq) output, keeping the first value of each output as
+  Brain.collect() does.
+  '''
+  def __init__(self, engine):
+    self.engine = engine
+    return
+
+  def put(self, item):
+    y0, i, seq = item
+    y = self.engine.results.get(seq)
+    if y != None and y[i] == None:
+      y[i] = y0
+    return
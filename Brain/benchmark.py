@@ -0,0 +1,299 @@
+#Throughput and scaling benchmarks of the FPNA engines
+from brain import Brain, i, f
+from reference import ReferenceEngine
+from actors import ActorEngine
+from compiler import CompiledBrain
+from scheduler import WorkerPool
+import os, sys, time, random
+
+#The engines a Brain can be benchmarked on
+ENGINES = ('processes', #Brain.start(), a process per resource
+           'scheduler', #Brain.schedule(), resources on worker processes
+           'pool', #Brain.start(pool), bound to a warm WorkerPool
+           'actors', #An ActorEngine, in this process
+           'reference', #The ReferenceEngine, in this process
+           'compiled', #A CompiledBrain, a batch at a time
+          )
+
+#------------------------------------------------------------------------------
+def layered(sizes, seed=0, **kwargs):
+  '''
+  Returns a Brain with fully connected layers of sizes[0] InputNodes, then
+  Activators, then sizes[-1] OutputNodes, like a multilayer perceptron.
+  Each connection has a Link with random W and T.  kwargs go to Brain().
+  '''
+  assert len(sizes) >= 2, 'There must be an input and an output layer'
+  rnd = random.Random(seed)
+  B = Brain(**kwargs)
+  prev = [B.createInputNode(1) for k in range(sizes[0])]
+  for n, size in enumerate(sizes[1:]):
+    if n == len(sizes) - 2:
+      create = B.createOutputNode
+    else:
+      create = B.createActivator
+    layer = [create(i, f, len(prev), rnd.uniform(-1, 1)) for k in range(size)]
+    for R in prev:
+      for A in layer:
+        _connect(B, R, A, rnd)
+    prev = layer
+  return B
+
+#------------------------------------------------------------------------------
+def randomSparse(numActivators, fanIn=3, numInputs=4, numOutputs=2, seed=0,
+                 **kwargs):
+  '''
+  Returns a Brain of numActivators Activators in a random directed acyclic
+  network, as FPNA allows.  Each Activator and OutputNode gets fanIn Links
+  from random InputNodes or earlier Activators, and every Activator without
+  an output feeds one of the OutputNodes, so each fires once per input
+  vector.  kwargs go to Brain().
+  '''
+  rnd = random.Random(seed)
+  B = Brain(**kwargs)
+  sources = [B.createInputNode(1) for k in range(numInputs)]
+  edges = [] #(source, Activator or OutputNode)
+  for k in range(numActivators):
+    A = B.createActivator(i, f, fanIn, rnd.uniform(-1, 1))
+    edges += [(rnd.choice(sources), A) for n in range(fanIn)]
+    sources.append(A)
+
+  #The sources of each OutputNode, including every source left without an
+  #output
+  chosen = [[rnd.choice(sources[numInputs:] or sources) for n in range(fanIn)]
+            for k in range(numOutputs)]
+  fed = set(R.ID for R, A in edges)
+  fed.update(R.ID for inputs in chosen for R in inputs)
+  for k, R in enumerate(R for R in sources if R.ID not in fed):
+    chosen[k % numOutputs].append(R)
+  for inputs in chosen:
+    O = B.createOutputNode(i, f, len(inputs), rnd.uniform(-1, 1))
+    edges += [(R, O) for R in inputs]
+
+  for R, A in edges:
+    _connect(B, R, A, rnd)
+  return B
+
+#------------------------------------------------------------------------------
+def wideFanIn(width, seed=0, **kwargs):
+  '''
+  Returns a Brain of width InputNodes, each with a Link to one OutputNode,
+  so every value of an input vector goes to the same resource.  kwargs go
+  to Brain().
+  '''
+  rnd = random.Random(seed)
+  B = Brain(**kwargs)
+  O = B.createOutputNode(i, f, width, 0.0)
+  for k in range(width):
+    _connect(B, B.createInputNode(1), O, rnd)
+  return B
+
+#------------------------------------------------------------------------------
+def benchmark(build, engine, numVectors=200, depth=16, numWorkers=None,
+              pool=None, seed=0):
+  '''
+  Builds a Brain with build(), a callable taking no arguments, runs it on
+  engine (one of ENGINES) and returns a dict of:
+    resources: The number of resources
+    build: Seconds taken by build()
+    startup: Seconds from the built Brain to the first output vector
+    vectorsPerSecond: Input vectors scored per second, numVectors of them
+      streamed depth at a time (or as one batch for 'compiled')
+    p50, p99: Seconds from submitting one input vector, with nothing else in
+      flight, to its output vector
+    memoryPerResource: Bytes of memory the network takes per resource, this
+      process's growth plus what the processes running it hold privately,
+      or None where it can not be read
+
+  numWorkers is for 'scheduler' and 'pool' (by default one per core), and
+  pool is the WorkerPool for 'pool' (one is made and closed if None).
+  '''
+  assert engine in ENGINES, 'engine must be one of %s' %(ENGINES,)
+  rnd = random.Random(seed)
+  ownPool = engine == 'pool' and pool == None
+  if ownPool: #Forked before the Brain is built, as WorkerPool asks
+    pool = WorkerPool(numWorkers)
+  before = _memory(os.getpid())
+  t = time.time()
+  B = build()
+  buildTime = time.time() - t
+  numResources = len(B.inputList + B.LinkList + B.ActList + B.outputList)
+  Xs = [[tuple(rnd.random() for k in range(node.n)) for node in B.inputList]
+        for n in range(numVectors)]
+
+  try:
+    t = time.time()
+    if engine == 'processes':
+      B.start()
+      run = B
+    elif engine == 'scheduler':
+      B.schedule(numWorkers)
+      run = B
+    elif engine == 'pool':
+      B.start(pool = pool)
+      run = B
+    elif engine == 'actors':
+      run = ActorEngine(B)
+    elif engine == 'reference':
+      run = ReferenceEngine(B)
+    else:
+      run = CompiledBrain(B)
+    run.activate(Xs[0])
+    startup = time.time() - t
+
+    memory = [_memory(os.getpid()), before]
+    memory += [_memory(pid, private = True) for pid in _pids(B, engine, pool)]
+    if None in memory:
+      memoryPerResource = None
+    else:
+      memoryPerResource = (memory[0] - memory[1] + sum(memory[2:])) / \
+                          float(numResources)
+
+    latencies = []
+    for X in Xs[:min(numVectors, 100)]:
+      t = time.time()
+      run.activate(X)
+      latencies.append(time.time() - t)
+    latencies.sort()
+
+    t = time.time()
+    if engine in ('processes', 'scheduler', 'pool'):
+      for y in B.activateStream(Xs, depth):
+        pass
+    elif engine == 'actors':
+      for k in range(0, numVectors, depth):
+        for seq in [run.submit(X) for X in Xs[k:k + depth]]:
+          run.collect(seq)
+    elif engine == 'compiled':
+      run.activate([[x for xs in X for x in xs] for X in Xs])
+    else:
+      for X in Xs:
+        run.activate(X)
+    elapsed = time.time() - t
+  finally:
+    B.stop()
+    if ownPool:
+      pool.close()
+  return {'resources': numResources,
+          'build': buildTime,
+          'startup': startup,
+          'vectorsPerSecond': numVectors / elapsed,
+          'p50': _percentile(latencies, 0.50),
+          'p99': _percentile(latencies, 0.99),
+          'memoryPerResource': memoryPerResource,
+          }
+
+#------------------------------------------------------------------------------
+def suite(maxResources=1000, engines=ENGINES, numVectors=200, numWorkers=None):
+  '''
+  Benchmarks each graph shape at sizes from about 10 resources up to about
+  maxResources on each engine, and prints a table of the results.  Runs
+  which fail, eg. a process per resource running out of file descriptors,
+  are reported and skipped.  Returns a list of (shape, engine, result)
+  where result is benchmark()'s dict or the exception raised.
+  '''
+  results = []
+  header = ('%-22s %-10s %6s %8s %8s %10s %9s %9s %9s' %
+            ('shape', 'engine', 'res', 'build s', 'start s', 'vectors/s',
+             'p50 ms', 'p99 ms', 'KB/res'))
+  print header
+  print '-'*len(header)
+  for name, build in _shapes(maxResources):
+    for engine in engines:
+      try:
+        r = benchmark(build, engine, numVectors, numWorkers = numWorkers)
+      except Exception, e:
+        print '%-22s %-10s failed: %s' %(name, engine, e)
+        results.append((name, engine, e))
+        continue
+      if r['memoryPerResource'] == None:
+        memory = '?'
+      else:
+        memory = '%.1f' %(r['memoryPerResource'] / 1024.0)
+      print ('%-22s %-10s %6d %8.3f %8.3f %10.1f %9.3f %9.3f %9s' %
+             (name, engine, r['resources'], r['build'], r['startup'],
+              r['vectorsPerSecond'], r['p50']*1e3, r['p99']*1e3, memory))
+      sys.stdout.flush()
+      results.append((name, engine, r))
+  return results
+
+#PRIVATE**********************************************************************
+#------------------------------------------------------------------------------
+def _connect(B, R1, R2, rnd):
+  '''
+  Connects R1 to R2 through a new Link with random W and T.
+  '''
+  L = B.createLink(rnd.uniform(-1, 1), rnd.uniform(-0.1, 0.1))
+  B.createConnection(R1, L)
+  B.createConnection(L, R2)
+  return
+
+#------------------------------------------------------------------------------
+def _shapes(maxResources):
+  '''
+  Returns (name, build) for each graph shape at sizes of about 10, 100,
+  1000, ... resources, up to maxResources.
+  '''
+  shapes = []
+  size = 10
+  while size <= maxResources:
+    #A square layer of n Activators has about n*n Links
+    n = max(2, int((size / 3.0)**0.5))
+    shapes.append(('layered %d' %size,
+                   lambda n=n: layered([n, n, n, 2])))
+    shapes.append(('randomSparse %d' %size,
+                   lambda size=size: randomSparse(max(1, size / 5), 4)))
+    shapes.append(('wideFanIn %d' %size,
+                   lambda size=size: wideFanIn(max(1, size / 2))))
+    size *= 10
+  return shapes
+
+#------------------------------------------------------------------------------
+def _pids(brain, engine, pool):
+  '''
+  Returns the pids of the processes running brain on engine.
+  '''
+  if engine == 'processes':
+    return [P.pid for P in brain.processes]
+  if engine == 'scheduler':
+    return [P.pid for P in brain.scheduler.workers]
+  if engine == 'pool':
+    return [P.pid for P in pool.workers]
+  return []
+
+#------------------------------------------------------------------------------
+def _memory(pid, private=False):
+  '''
+  Returns the resident memory of the process pid in bytes, or with private
+  only the pages no other process shares, so a forked process is not
+  charged for the pages it still shares with its parent.  Read from /proc,
+  or None where there is none.
+  '''
+  try:
+    if not private:
+      with open('/proc/%d/statm' %pid) as statm:
+        return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    if os.path.exists('/proc/%d/smaps_rollup' %pid):
+      fileName = '/proc/%d/smaps_rollup' %pid
+    else:
+      fileName = '/proc/%d/smaps' %pid
+    kB = 0
+    with open(fileName) as smaps:
+      for line in smaps:
+        if line.startswith('Private_'):
+          kB += int(line.split()[1])
+    return kB * 1024
+  except IOError:
+    return None
+
+#------------------------------------------------------------------------------
+def _percentile(values, p):
+  '''
+  Returns the p'th quantile (0 to 1) of the sorted list values.
+  '''
+  return values[min(len(values) - 1, int(p * len(values)))]
+
+if __name__ == '__main__':
+  if len(sys.argv) > 1:
+    suite(int(sys.argv[1]))
+  else:
+    suite()
@@ -1,7 +1,22 @@
 #Parallel FPNA implementation
 from tissue import Link, Activator, InputNode, OutputNode
+from reference import ReferenceEngine
+from actors import ActorEngine
+from channel import RingChannel
+from credit import Credit
+from scheduler import Scheduler, WorkerPool
+from trace import TraceBuffer, writeChromeTrace
 from multiprocessing import Process, Queue, Lock, Event, Value
+from collections import deque
+from Queue import Empty
 import time, math
+try:
+  import asyncio
+except ImportError:
+  try:
+    import trollius as asyncio #The Python 2 port of asyncio
+  except ImportError:
+    asyncio = None
 
 #------------------------------------------------------------------------------
 class Brain():
@@ -10,9 +25,25 @@ class Brain():
   handles building the network.
   '''
   #----------------------------------------------------------------------------
-  def __init__(self):
+  def __init__(self, channel=Queue, window=32, creditBatch=8, trace=0):
     '''
+    (callable)channel: Makes the channel each Link, Activator and OutputNode
+    reads its values from.  The default is a multiprocessing Queue; a
+    channel.RingChannel passes the values through shared memory instead.
+    (int)window: The number of values a resource may send on each of its
+    output connections before the receiver has read them, and the number of
+    input vectors the Brain may send to each InputNode before it has read
+    them.
+    (int)creditBatch: The number of values a resource reads from an input
+    before giving the credits back to it.
+    (int)trace: The number of trace events each resource keeps for
+    exportTrace(), or 0 to not trace.
     '''
+    assert 0 < creditBatch <= window, 'creditBatch must be in 1..window'
+    self.channel = channel
+    self.window = window
+    self.creditBatch = creditBatch
+    self.trace = trace
     self.LinkList = []
     self.ActList = []
     self.inputList = []
@@ -24,27 +55,30 @@ class Brain():
     self.outputCount = 1
 
     self.dataQueue = Queue()
-    self.ACKCount = Value('I', 0)
-    self.ACKEvent = Event()
-    self.ACKMax = Value('I', 0)
+    self.numInputs = 0 #The length of an input vector
+    self.credits = {} #InputNode ID: credits taken but not yet spent
+
+    self.seqCount = 0 #Sequence number of the next input vector
+    self.results = {} #seq: output vector, for input vectors in flight
+    self.futures = {} #seq: Future, for input vectors from activateAsync()
+    self.loop = None #Event loop watching dataQueue for activateAsync()
+
+    self.running = False
+    self.processes = [] #One per resource, from start()
+    self.scheduler = None #From schedule()
+    self.pool = None #The WorkerPool the Brain is bound to
     return
 
   #----------------------------------------------------------------------------
   def createLink(self, W, T):
     '''
     '''
-    #Values are automatically locked.  You can use:
-    #with ACKCount.get_lock():
-    #  ACKCount += 1
-    ACKCount = Value('I', 0) #Unsigned int
-    ACKEvent = Event()
-    ACKMax = Value('I', 0)
-    dataQueue = Queue()
+    dataQueue = self.channel()
     ID = 'L_' + str(self.LinkCount)
     self.LinkCount += 1
 
     #Create the Link
-    newLink = Link(W, T, ACKCount, ACKEvent, ACKMax, dataQueue, ID)
+    newLink = Link(W, T, dataQueue, ID, self.creditBatch, self._traceBuffer())
 
     #Append the Link to the list
     self.LinkList.append(newLink)
@@ -54,15 +88,12 @@ class Brain():
   def createActivator(self, i, f, iterateMax, theta):
     '''
     '''
-    ACKCount = Value('I', 0)
-    ACKEvent = Event()
-    ACKMax = Value('I', 0)
-    dataQueue = Queue()
+    dataQueue = self.channel()
     ID = 'A_' + str(self.ActCount)
     self.ActCount += 1
     
-    newAct = Activator(i, f, ACKCount, ACKEvent, ACKMax, dataQueue,
-                             ID, iterateMax, theta)
+    newAct = Activator(i, f, dataQueue, ID, iterateMax, theta,
+                       self.creditBatch, self._traceBuffer())
                              
     self.ActList.append(newAct)
     return newAct
@@ -77,24 +108,17 @@ class Brain():
     passed as an n-length tuple
     '''
     
-    #The brain has a 'global' ACK count for every input node.  Since each input
-    #node may receive multiple values for each input vector.  This is a 
-    #performance bottleneck as each InputNode must share the same lock on the
-    #Brain's ACK counter.
-
-    ACKCount = Value('I', 0)
-    brainACKCount = self.ACKCount
-    ACKEvent = Event()
-    brainACKEvent = self.ACKEvent
-    ACKMax = Value('I', 0)
-    brainACKMax = self.ACKMax
+    #Each InputNode has its own credits from the Brain, so the InputNodes do
+    #not share a lock.
+    credit = Credit(self.window)
     dataQueue = Queue()
     ID = 'I_' + str(self.inputCount)
     self.inputCount += 1
     
-    newInput = InputNode(ACKCount, ACKEvent, ACKMax, dataQueue,
-                         ID, brainACKCount, brainACKEvent, brainACKMax, n)
-    self.ACKMax.value += n
+    newInput = InputNode(dataQueue, ID, credit, n, self.creditBatch,
+                         self._traceBuffer())
+    self.numInputs += n
+    self.credits[ID] = 0
     self.inputList.append(newInput)
     return newInput
 
@@ -102,13 +126,12 @@ class Brain():
   def createOutputNode(self, i, f, iterateMax, theta):
     '''
     '''
-    ACKEvent = Event()
-    dataQueue = Queue()
+    dataQueue = self.channel()
     ID = 'O_' + str(self.outputCount)
     
-    newOutput = OutputNode(i, f, ACKEvent, dataQueue,
-                           ID, iterateMax, theta, self.outputCount - 1,
-                           self.dataQueue)
+    newOutput = OutputNode(i, f, dataQueue, ID, iterateMax, theta,
+                           self.outputCount - 1, self.dataQueue,
+                           self.creditBatch, self._traceBuffer())
 
     self.outputCount += 1                             
     self.outputList.append(newOutput)
@@ -120,12 +143,114 @@ class Brain():
     '''
     '''
     assert not (isinstance(R1, Activator) and isinstance(R2, Activator))
-    R1.appendOutput(R2)
-    R1.ACKMax.value += 1
-    R2.appendInput(R1)
+    credit = Credit(self.window)
+    R1.appendOutput(R2, credit)
+    R2.appendInput(R1, credit)
     self.E.append((R1, R2))
     return
 
+  #----------------------------------------------------------------------------
+  def start(self, numWorkers=None, pool=None):
+    '''
+    Starts the finished network.  By default every resource runs in a
+    process of its own.  With numWorkers the resources are partitioned onto
+    that many worker processes (see schedule()), and with pool, a
+    scheduler.WorkerPool, the network is bound to the pool's running workers,
+    so no processes are started at all.  Call stop() when done.
+    '''
+    assert not self.running, 'The Brain is already started'
+    if pool != None:
+      pool.bind(self)
+      self.pool = pool
+      self.running = True
+    elif numWorkers != None:
+      self.schedule(numWorkers)
+    else:
+      for R in self._resources():
+        P = Process(target = R.activate)
+        P.daemon = True
+        P.start()
+        self.processes.append(P)
+      self.running = True
+    return
+
+  #----------------------------------------------------------------------------
+  def stop(self):
+    '''
+    Stops the network started by start() or schedule().  The processes are
+    sent a poison pill (None) and waited for, or the Brain is unbound from
+    its WorkerPool.  Input vectors still in flight are dropped and the
+    credits are reset, so the Brain can be started again.
+    '''
+    if not self.running:
+      return
+    if self.pool != None:
+      self.pool.unbind()
+      self.pool = None
+    elif self.scheduler != None:
+      self.scheduler.stop()
+      self.scheduler = None
+    else:
+      for R in self._resources():
+        R.dataQueue.put(None)
+      for P in self.processes:
+        P.join()
+      self.processes = []
+
+    for R in self._resources() + [self]:
+      while True:
+        try:
+          R.dataQueue.get(False)
+        except Empty:
+          break
+    for R1, R2 in self.E:
+      R1.outputList[R2.ID]['credit'].reset()
+    for node in self.inputList:
+      node.credit.reset()
+      self.credits[node.ID] = 0
+    for future in self.futures.values():
+      future.cancel()
+    self.futures.clear()
+    self.results.clear()
+    if self.loop != None:
+      self.loop.remove_reader(self.dataQueue._reader.fileno())
+      self.loop = None
+    self.running = False
+    return
+
+  #----------------------------------------------------------------------------
+  def stats(self):
+    '''
+    Returns a dict of resource ID: dict of its counters (see stats.FIELDS),
+    read from shared memory while the network keeps running.  The counters
+    of a network bound to a WorkerPool stay in the pool's workers, so they
+    are not included.
+    '''
+    return dict((R.ID, R.counters.toDict()) for R in self._resources())
+
+  #----------------------------------------------------------------------------
+  def exportTrace(self, fileName):
+    '''
+    Writes the trace events the resources have kept (see the trace argument
+    of the constructor) to fileName as Chrome trace JSON, for
+    chrome://tracing or Perfetto.  Works while the network is running.
+    Returns the number of events written.
+    '''
+    return writeChromeTrace(self._resources(), fileName)
+
+  #----------------------------------------------------------------------------
+  def schedule(self, numWorkers=None):
+    '''
+    Starts the finished network on numWorkers worker processes (by default
+    one per core) instead of one process per resource, and returns the
+    scheduler.Scheduler.  activate() and the rest are used as before.
+    '''
+    assert not self.running, 'The Brain is already started'
+    self.scheduler = Scheduler(self, numWorkers)
+    self.scheduler.start()
+    self.running = True
+    return self.scheduler
+
   #----------------------------------------------------------------------------
   def activate(self, X):
     '''
@@ -133,21 +258,146 @@ class Brain():
     passed to the i'th InputNode.  Each element of x should be a tuple of
     length n of floats which will be sent to the InputNode.
     '''
-    assert sum([len(x) for x in X]) == self.ACKMax.value
+    return self.collect(self.submit(X))
+
+  #----------------------------------------------------------------------------
+  def submit(self, X):
+    '''
+    Sends the input vector X (as for activate()) into the network without
+    waiting for its output, and returns its sequence number for collect().
+    Every value in the network is tagged with the sequence number of the
+    input vector it came from, so several input vectors can be in flight
+    at once.  Waits if window input vectors are already waiting at an
+    InputNode.
+    '''
+    assert sum([len(x) for x in X]) == self.numInputs
     assert isinstance(X, list)
-    print 'Brain ACKCount: %d' %self.ACKCount.value
+    seq = self.seqCount
+    self.seqCount += 1
+    self.results[seq] = [None]*len(self.outputList)
     for i in range(len(self.inputList)):
-      print 'pushing ' + str(X[i]) + ' to InputNode ' + str(self.inputList[i])
-      self.inputList[i].dataQueue.put(X[i])
-    self.ACKEvent.wait()
-    print 'Brain received all ACKs'
-    y = [None]*len(self.outputList) #Output vector
+      node = self.inputList[i]
+      if node.credit != None: #No Credit means no flow control
+        if self.credits[node.ID] == 0:
+          self.credits[node.ID] = node.credit.take()
+        self.credits[node.ID] -= 1
+      node.dataQueue.put((X[i], seq))
+    return seq
+
+  #----------------------------------------------------------------------------
+  def collect(self, seq):
+    '''
+    Waits for and returns the output vector of the input vector with
+    sequence number seq.  Outputs of other input vectors which arrive in
+    the meantime are kept until they are collected.
+    '''
+    y = self.results[seq]
     while None in y:
-      y0, i = self.dataQueue.get()
-      print 'BRAIN DATA: ' + str(y)
-      y[i] = y0
+      self._deliver(*self.dataQueue.get())
+    del self.results[seq]
     return y
 
+  #----------------------------------------------------------------------------
+  def activateAsync(self, X, loop=None):
+    '''
+    Sends the input vector X (as for activate()) into the network and returns
+    an asyncio Future for its output vector, so an event loop can
+    'await B.activateAsync(X)' (or 'yield From(...)' with trollius) without
+    blocking.  Instead of a thread waiting in dataQueue.get(), the loop
+    watches the dataQueue pipe while any Futures are pending.  loop defaults
+    to asyncio.get_event_loop(), and all pending Futures must use the same
+    loop.
+    '''
+    if asyncio == None:
+      raise RuntimeError('activateAsync needs asyncio (trollius on Python 2)')
+    if loop == None:
+      loop = asyncio.get_event_loop()
+    if self.loop == None:
+      loop.add_reader(self.dataQueue._reader.fileno(), self._readOutputs)
+      self.loop = loop
+    elif not self.loop is loop:
+      raise RuntimeError('Futures are already pending on another event loop')
+
+    if hasattr(loop, 'create_future'):
+      future = loop.create_future()
+    else:
+      future = asyncio.Future(loop = loop)
+    seq = self.submit(X)
+    self.futures[seq] = future
+    return future
+
+  #----------------------------------------------------------------------------
+  def activateStream(self, Xs, depth=4):
+    '''
+    A generator which activates the network with every input vector in the
+    iterable Xs and yields their output vectors in order.  Up to depth input
+    vectors are in the network at once, one behind the other, so the
+    throughput depends on the depth of the pipeline rather than on the time
+    one vector takes to get through.
+    '''
+    assert depth >= 1
+    inFlight = deque()
+    for X in Xs:
+      if len(inFlight) == depth:
+        yield self.collect(inFlight.popleft())
+      inFlight.append(self.submit(X))
+    while inFlight:
+      yield self.collect(inFlight.popleft())
+    return
+
+#PRIVATE**********************************************************************
+  #----------------------------------------------------------------------------
+  def _resources(self):
+    '''
+    Returns every resource of the network.
+    '''
+    return self.inputList + self.LinkList + self.ActList + self.outputList
+
+  #----------------------------------------------------------------------------
+  def _traceBuffer(self):
+    '''
+    Returns a new TraceBuffer for a resource, or None if not tracing.
+    '''
+    if self.trace > 0:
+      return TraceBuffer(self.trace)
+    return None
+
+  #----------------------------------------------------------------------------
+  def _deliver(self, y0, i, seq):
+    '''
+    Stores the value y0 of output i of input vector seq, as read from the
+    dataQueue.  Only the first value for each output is kept, and values of
+    vectors which are no longer in flight are dropped.  Resolves the Future
+    of seq once its output vector is complete.
+    '''
+    y = self.results.get(seq)
+    if y == None or y[i] != None:
+      return
+    y[i] = y0
+    if seq in self.futures and not None in y:
+      future = self.futures.pop(seq)
+      del self.results[seq]
+      if not future.cancelled():
+        future.set_result(y)
+    return
+
+  #----------------------------------------------------------------------------
+  def _readOutputs(self):
+    '''
+    Called by the event loop when the dataQueue has data.  Delivers every
+    output waiting in it, and stops watching the dataQueue once no Futures
+    are pending.
+    '''
+    while True:
+      try:
+        self._deliver(*self.dataQueue.get(False))
+      except Empty:
+        break
+    if not self.futures:
+      self.loop.remove_reader(self.dataQueue._reader.fileno())
+      self.loop = None
+    return
+
 
 def i(x, xp):
   '''
@@ -159,45 +409,33 @@ def f(x):
   '''
   return 1.0 / (1.0 + math.exp(-x)) #Sigmoid function
 
-B = Brain()
-
-L1 = B.createLink(1.0, 0.0)
-L2 = B.createLink(1.0, 0.0)
-L3 = B.createLink(1.0, 0.0)
-
-A1 = B.createActivator(i, f, 5, 0.0)
-
-I1 = B.createInputNode(2)
-I2 = B.createInputNode(3)
-
-O1 = B.createOutputNode(i, f, 1, 0.0)
-O2 = B.createOutputNode(i, f, 1, 0.0)
-
-B.createConnection(L1, A1)
-B.createConnection(I1, L1)
-B.createConnection(I2, L1)
-B.createConnection(A1, L2)
-B.createConnection(L2, O1)
-B.createConnection(A1, L3)
-B.createConnection(L3, O2)
-
-P1 = Process(target = L1.activate)
-P2 = Process(target = A1.activate)
-P3 = Process(target = I1.activate)
-P4 = Process(target = I2.activate)
-P5 = Process(target = O1.activate)
-P6 = Process(target = L2.activate)
-P7 = Process(target = L3.activate)
-P8 = Process(target = O2.activate)
-
-P1.start()
-P2.start()
-P3.start()
-P4.start()
-P5.start()
-P6.start()
-P7.start()
-P8.start()
-
-y = B.activate([(1,1), (1,1,1)])
-print 'Output: ' + str(y)
+if __name__ == '__main__':
+  B = Brain()
+
+  L1 = B.createLink(1.0, 0.0)
+  L2 = B.createLink(1.0, 0.0)
+  L3 = B.createLink(1.0, 0.0)
+
+  A1 = B.createActivator(i, f, 5, 0.0)
+
+  I1 = B.createInputNode(2)
+  I2 = B.createInputNode(3)
+
+  O1 = B.createOutputNode(i, f, 1, 0.0)
+  O2 = B.createOutputNode(i, f, 1, 0.0)
+
+  B.createConnection(L1, A1)
+  B.createConnection(I1, L1)
+  B.createConnection(I2, L1)
+  B.createConnection(A1, L2)
+  B.createConnection(L2, O1)
+  B.createConnection(A1, L3)
+  B.createConnection(L3, O2)
+
+  B.start()
+  y = B.activate([(1,1), (1,1,1)])
+  print 'Output: ' + str(y)
+  B.stop()
+
+  R = ReferenceEngine(B)
+  print 'Reference output: ' + str(R.activate([(1,1), (1,1,1)]))
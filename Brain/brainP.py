@@ -133,10 +133,8 @@ class Brain():
     assert sum([len(x) for x in X]) == self.ACKMax.value
     assert isinstance(X, list)
     for i in range(len(self.inputList)):
-      print 'pushing ' + str(X[i]) + ' to InputNode ' + str(self.inputList[i])
       self.inputList[i].dataQueue.put(X[i])
     self.ACKEvent.wait()
-    print 'Brain received all ACKs'
     y = [None]*len(self.outputList) #Output vector
     while None in y:
       y0, i = self.dataQueue.get()
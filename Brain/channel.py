@@ -0,0 +1,97 @@
+#Shared memory channels between resources
+from multiprocessing import Lock, Semaphore
+from multiprocessing.sharedctypes import RawArray, RawValue
+from Queue import Empty
+import ctypes
+
+#Longest resource ID a RingChannel record can hold
+ID_SIZE = 16
+
+#------------------------------------------------------------------------------
+class RingChannel():
+  '''
+  A drop-in replacement for the multiprocessing Queue a Link, Activator or
+  OutputNode reads its (x, ID, seq) values from.  The values are written
+  into fixed size records of a ring buffer in shared memory, so a put() is a
+  semaphore, a lock and a copy of the record instead of pickling the tuple,
+  handing it to a feeder thread and writing it to a pipe.
+
+  Any number of processes may put() into a channel, but only one (the
+  resource that owns it) may get() from it.  put() blocks while the ring is
+  full.  The channels must be made before the resource processes are
+  started, so they are inherited.
+  '''
+  #----------------------------------------------------------------------------
+  def __init__(self, capacity=1024):
+    '''
+    (int)capacity: The number of records in the ring.  Each input of a
+    resource has at most the Brain's window of values in flight, so put()
+    never waits if this is at least window times the number of inputs.
+    '''
+    assert capacity > 0, 'capacity must be positive'
+    self.capacity = capacity
+    self.records = RawArray(_Record, capacity)
+    self.head = RawValue(ctypes.c_long, 0) #Next record to write
+    self.tail = RawValue(ctypes.c_long, 0) #Next record to read
+    self.free = Semaphore(capacity) #Records which can be written
+    self.used = Semaphore(0) #Records which can be read
+    self.lock = Lock() #Between writers
+    return
+
+  #----------------------------------------------------------------------------
+  def put(self, item):
+    '''
+    Writes item, a tuple (float x, str ID, int seq) or None, to the ring.
+    None is written as a record with an empty ID.  Raises a ValueError if ID
+    is longer than ID_SIZE.
+    '''
+    if item == None:
+      x, ID, seq = 0.0, '', 0
+    else:
+      x, ID, seq = item
+    if len(ID) > ID_SIZE:
+      raise ValueError('ID %s is longer than %d characters' %(ID, ID_SIZE))
+    self.free.acquire()
+    with self.lock:
+      record = self.records[self.head.value]
+      record.x = x
+      record.ID = ID
+      record.seq = seq
+      self.head.value = (self.head.value + 1) % self.capacity
+    self.used.release()
+    return
+
+  #----------------------------------------------------------------------------
+  def get(self, block=True, timeout=None):
+    '''
+    Reads the oldest item from the ring, waiting for one if block is True
+    (for at most timeout seconds).  Raises Queue.Empty if there is none, as
+    a multiprocessing Queue does.
+    '''
+    if not self.used.acquire(block, timeout):
+      raise Empty
+    record = self.records[self.tail.value]
+    if record.ID:
+      item = (record.x, record.ID, record.seq)
+    else:
+      item = None
+    self.tail.value = (self.tail.value + 1) % self.capacity
+    self.free.release()
+    return item
+
+  #----------------------------------------------------------------------------
+  def qsize(self):
+    '''
+    Returns the number of items waiting in the ring.
+    '''
+    return self.used.get_value()
+
+#PRIVATE**********************************************************************
+#------------------------------------------------------------------------------
+class _Record(ctypes.Structure):
+  '''
+  One (x, ID, seq) value in a RingChannel.
+  '''
+  _fields_ = [('x', ctypes.c_double),
+              ('seq', ctypes.c_long),
+              ('ID', ctypes.c_char*ID_SIZE)]
@@ -0,0 +1,195 @@
+#Batched NumPy FPNA implementation
+from tissue import Link, OutputNode
+from collections import deque
+import numpy as np
+
+#------------------------------------------------------------------------------
+class CompiledBrain():
+  '''
+  A Brain's network compiled into matrix operations, to score a whole batch
+  of input vectors with a few np.dot calls instead of passing every value
+  through the resource processes.
+
+  The network is compiled by sending one symbolic input vector through it
+  the same way the ReferenceEngine does, except that every value is an
+  affine expression of the inputs and of earlier Activator outputs.  Each
+  Activator and OutputNode then has a pre-activation theta + sum(W*x + T),
+  which becomes a row of a weight matrix.  Rows are grouped into levels by
+  how many Activators lie before them, and a level is evaluated for the
+  whole batch as f(V.W' + b).
+
+  This needs i(x, xp) to be x + xp, and every Activator and OutputNode to
+  fire exactly once per input vector (ie. receive exactly iterateMax values),
+  which holds for layered networks.  Otherwise the constructor raises a
+  ValueError and the ReferenceEngine has to be used.
+  '''
+  #----------------------------------------------------------------------------
+  def __init__(self, brain):
+    '''
+    (Brain)brain: The finished Brain to compile.
+    '''
+    self.numInputs = sum(node.n for node in brain.inputList)
+    self.numOutputs = len(brain.outputList)
+    self.levels = []
+
+    outputs = {}
+    for R1, R2 in brain.E:
+      outputs.setdefault(R1.ID, []).append(R2)
+    for R in brain.ActList + brain.outputList:
+      if not _isSum(R.i):
+        raise ValueError('%s can only be compiled if i(x, xp) = x + xp' %R)
+
+    #Send a symbolic input vector through.  A value is a pair (coefs,
+    #const) meaning const + sum(coefs[c]*V[c]), where V holds the inputs
+    #followed by the Activator outputs.
+    messages = deque()
+    column = 0
+    for node in brain.inputList:
+      for k in range(node.n):
+        for R in outputs.get(node.ID, []):
+          messages.append((R, ({column: 1.0}, 0.0)))
+        column += 1
+
+    state = dict((R.ID, [{}, R.theta, 0]) for R in brain.ActList +
+                 brain.outputList)
+    fired = []
+    firedIDs = set()
+    level = [0]*self.numInputs
+    while messages:
+      R, (coefs, const) = messages.popleft()
+      if isinstance(R, Link):
+        value = (dict((c, R.W*w) for c, w in coefs.items()), R.W*const + R.T)
+        for Rp in outputs.get(R.ID, []):
+          messages.append((Rp, value))
+        continue
+
+      s = state[R.ID]
+      for c, w in coefs.items():
+        s[0][c] = s[0].get(c, 0.0) + w
+      s[1] += const
+      s[2] += 1
+      if s[2] < R.iterateMax:
+        continue
+      if s[2] > R.iterateMax or R.ID in firedIDs:
+        raise ValueError('%s fires more than once per input vector' %R)
+      firedIDs.add(R.ID)
+      fired.append((R, s[0], s[1],
+                    1 + max([level[c] for c in s[0]] or [0])))
+      if not isinstance(R, OutputNode):
+        level.append(fired[-1][3])
+        for Rp in outputs.get(R.ID, []):
+          messages.append((Rp, ({column: 1.0}, 0.0)))
+        column += 1
+
+    for R in brain.ActList + brain.outputList:
+      if not R.ID in firedIDs:
+        raise ValueError('%s does not fire exactly once per input vector' %R)
+    self.numColumns = column
+
+    #Build the matrices one level at a time
+    column = self.numInputs
+    columns = {}
+    for R, coefs, const, depth in fired:
+      if not isinstance(R, OutputNode):
+        columns[R.ID] = column
+        column += 1
+    for depth in sorted(set(f[3] for f in fired)):
+      rows = [f for f in fired if f[3] == depth]
+      used = sorted(set(c for f in rows for c in f[1]))
+      position = dict((c, j) for j, c in enumerate(used))
+      M = np.zeros(shape = [len(rows), len(used)])
+      for r in range(len(rows)):
+        for c, w in rows[r][1].items():
+          M[r, position[c]] = w
+      groups = {}
+      for r in range(len(rows)):
+        groups.setdefault(rows[r][0].f, []).append(r)
+      self.levels.append({
+        'used': np.array(used, dtype = np.intp),
+        'M': M,
+        'b': np.array([f[2] for f in rows]),
+        'f': [(_vectorize(fn), np.array(r, dtype = np.intp))
+              for fn, r in groups.items()],
+        'columnRows': np.array([r for r in range(len(rows))
+                                if not isinstance(rows[r][0], OutputNode)],
+                               dtype = np.intp),
+        'columns': np.array([columns[f[0].ID] for f in rows
+                             if not isinstance(f[0], OutputNode)],
+                            dtype = np.intp),
+        'outputRows': np.array([r for r in range(len(rows))
+                                if isinstance(rows[r][0], OutputNode)],
+                               dtype = np.intp),
+        'outputs': np.array([f[0].index for f in rows
+                             if isinstance(f[0], OutputNode)],
+                            dtype = np.intp),
+        })
+    return
+
+  #----------------------------------------------------------------------------
+  def activate(self, X):
+    '''
+    (2d array of floats)X: A batch of input vectors, one per row.  Each row
+    holds the values for every InputNode one after another, eg. the
+    features from DataMiner.getTestData().  A single input vector in the
+    form taken by Brain.activate() (a list of tuples) is also accepted.
+
+    Returns a 2d np.array with the output vector for each row of X, or a
+    list for a single Brain.activate() style input vector.
+    '''
+    single = isinstance(X, list) and len(X) > 0 and isinstance(X[0], tuple)
+    if single:
+      X = [[x for xs in X for x in xs]]
+    X = np.asarray(X, dtype = np.float64)
+    if X.ndim != 2 or X.shape[1] != self.numInputs:
+      raise ValueError('X must have %d values per row' %self.numInputs)
+
+    V = np.empty(shape = [len(X), self.numColumns])
+    V[:, :self.numInputs] = X
+    Y = np.empty(shape = [len(X), self.numOutputs])
+    for level in self.levels:
+      Z = np.dot(V[:, level['used']], level['M'].T)
+      Z += level['b']
+      for f, rows in level['f']:
+        Z[:, rows] = f(Z[:, rows])
+      V[:, level['columns']] = Z[:, level['columnRows']]
+      Y[:, level['outputs']] = Z[:, level['outputRows']]
+
+    if single:
+      return Y[0].tolist()
+    return Y
+
+#------------------------------------------------------------------------------
+def compileBrain(brain):
+  '''
+  Returns the CompiledBrain for brain.
+  '''
+  return CompiledBrain(brain)
+
+#PRIVATE**********************************************************************
+#------------------------------------------------------------------------------
+def _isSum(i):
+  '''
+  Returns True if the iteration function i adds its arguments, judged from
+  a few sample values.
+  '''
+  try:
+    return all(abs(i(a, b) - (a + b)) <= 1e-12*(1 + abs(a + b))
+               for a, b in ((0.0, 0.0), (1.5, -0.25), (-3.0, 7.0), (1e3, 2.5)))
+  except Exception:
+    return False
+
+#------------------------------------------------------------------------------
+def _vectorize(f):
+  '''
+  Returns f if it already works elementwise on np.arrays (eg. it uses np.exp),
+  or an np.vectorize wrapper around it (eg. if it uses math.exp).
+  '''
+  sample = np.array([[-1.0, 0.0], [0.5, 2.0]])
+  try:
+    y = f(sample)
+    if (isinstance(y, np.ndarray) and y.shape == sample.shape and
+        np.allclose(y, [[f(x) for x in row] for row in sample.tolist()])):
+      return f
+  except Exception:
+    pass
+  return np.vectorize(f, otypes = [np.float64])
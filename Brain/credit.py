@@ -0,0 +1,63 @@
+#Credit based flow control between resources
+from multiprocessing import Condition
+from multiprocessing.sharedctypes import RawValue
+import ctypes
+
+#------------------------------------------------------------------------------
+class Credit():
+  '''
+  The credits of one edge of the network.  The sender may have up to window
+  values on the edge which the receiver has not read yet.  It takes every
+  credit there is at once and spends them one per value, and the receiver
+  gives them back in batches, so the lock is taken about once per batch
+  instead of once per value as with the ACK handshake.
+
+  Made before the resource processes are started, so they inherit it.
+  '''
+  #----------------------------------------------------------------------------
+  def __init__(self, window):
+    '''
+    (int)window: The number of values the sender may have in flight.
+    '''
+    assert window > 0, 'window must be positive'
+    self.window = window
+    self.count = RawValue(ctypes.c_int, window)
+    self.condition = Condition()
+    return
+
+  #----------------------------------------------------------------------------
+  def take(self, block=True):
+    '''
+    Takes and returns every credit there is.  If there are none it waits for
+    some to be given back, or returns 0 if block is False.
+    '''
+    with self.condition:
+      while self.count.value == 0:
+        if not block:
+          return 0
+        self.condition.wait()
+      n = self.count.value
+      self.count.value = 0
+    return n
+
+  #----------------------------------------------------------------------------
+  def give(self, n):
+    '''
+    Gives n credits back to the sender.
+    '''
+    with self.condition:
+      self.count.value += n
+      assert self.count.value <= self.window, 'More credits given than taken'
+      self.condition.notify()
+    return
+
+  #----------------------------------------------------------------------------
+  def reset(self):
+    '''
+    Gives the sender the whole window again, eg. after the network has been
+    stopped with values still in flight.
+    '''
+    with self.condition:
+      self.count.value = self.window
+      self.condition.notify()
+    return
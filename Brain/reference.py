@@ -0,0 +1,86 @@
+#Sequential reference FPNA implementation
+from tissue import Link, OutputNode
+from collections import deque
+
+#------------------------------------------------------------------------------
+class ReferenceEngine():
+  '''
+  Evaluates a Brain's network in a single process.  Instead of running every
+  resource as a process and passing values through Queues, it keeps one
+  FIFO of (resource, value) messages and hands each message to its resource
+  in turn, so a value moves through the network in the same wave as in the
+  parallel version: Links compute W*x + T, Activators and OutputNodes apply
+  i() to every value and f() after iterateMax values.  Like the resource
+  processes it starts every input vector from a fresh Activator and
+  OutputNode state, and keeps the first value each OutputNode gives.  It
+  gives the same outputs as Brain.activate(), so it can be used as a low
+  latency baseline and to check the parallel version.
+  '''
+  #----------------------------------------------------------------------------
+  def __init__(self, brain):
+    '''
+    (Brain)brain: The Brain to evaluate.  It is only read, and the network
+    should be finished before the engine is made.
+    '''
+    self.brain = brain
+    self.outputs = {}
+    for R in brain.LinkList + brain.ActList + brain.inputList:
+      self.outputs[R.ID] = []
+    for R1, R2 in brain.E:
+      self.outputs[R1.ID].append(R2)
+
+    self.state = {}
+    self.reset()
+    return
+
+  #----------------------------------------------------------------------------
+  def reset(self):
+    '''
+    Puts every Activator and OutputNode back to its initial state.
+    '''
+    for R in self.brain.ActList + self.brain.outputList:
+      self.state[R.ID] = [R.theta, 0]
+    return
+
+  #----------------------------------------------------------------------------
+  def activate(self, X):
+    '''
+    (List of tuples of floats)X: The input vector, as for Brain.activate().
+    Returns the output vector.  Raises a RuntimeError if an OutputNode does
+    not fire, where the parallel version would wait forever.
+    '''
+    assert isinstance(X, list)
+    assert len(X) == len(self.brain.inputList)
+    self.reset()
+    y = [None]*len(self.brain.outputList)
+    messages = deque()
+    for node, x in zip(self.brain.inputList, X):
+      if len(x) != node.n:
+        raise ValueError('Input X must have length %d' %node.n)
+      for value in x:
+        for R in self.outputs[node.ID]:
+          messages.append((R, value))
+
+    while messages:
+      R, x = messages.popleft()
+      if isinstance(R, Link):
+        xp = R.W*x + R.T
+      else:
+        state = self.state[R.ID]
+        state[0] = R.i(state[0], x)
+        state[1] += 1
+        if state[1] != R.iterateMax:
+          continue
+        xp = R.f(state[0])
+        state[0], state[1] = R.theta, 0
+        if isinstance(R, OutputNode):
+          if y[R.index] == None:
+            y[R.index] = xp
+          continue
+      for Rp in self.outputs[R.ID]:
+        messages.append((Rp, xp))
+
+    if None in y:
+      raise RuntimeError('OutputNode %s did not fire' %
+                         self.brain.outputList[y.index(None)])
+    return y
@@ -0,0 +1,471 @@
+#Runs a Brain's resources on a fixed pool of worker processes
+from tissue import Link, Activator, InputNode, OutputNode
+from multiprocessing import Process, Queue, cpu_count
+from collections import deque
+from Queue import Empty
+import os
+
+#------------------------------------------------------------------------------
+class Scheduler():
+  '''
+  Runs every resource of a Brain on one of a fixed number of worker
+  processes, instead of one process per resource.  The resources are
+  partitioned so that few connections cross from one worker to another.
+
+  Each worker keeps a deque of the values passed between its own resources
+  and calls handle() on the receiving resource directly, so those values are
+  never pickled.  Values for a resource on another worker are gathered and
+  sent to that worker's inbox as one list once the deque is empty.  The
+  connections between resources are not flow controlled; the Brain's
+  credits for its InputNodes still are.
+
+  A Brain is run either by a Scheduler or by one Process per resource, not
+  both, since the Scheduler routes the Brain's input vectors to the workers.
+  '''
+  #----------------------------------------------------------------------------
+  def __init__(self, brain, numWorkers=None):
+    '''
+    (Brain)brain: The finished Brain to run.
+    (int)numWorkers: The number of worker processes.  The default is one per
+    core.  There are never more workers than resources.
+    '''
+    resources = _resources(brain)
+    if numWorkers == None:
+      numWorkers = cpu_count()
+    assert numWorkers > 0, 'numWorkers must be positive'
+    numWorkers = min(numWorkers, len(resources))
+
+    self.brain = brain
+    self.numWorkers = numWorkers
+    self.assignment = partition(brain, numWorkers)
+    self.inboxes = [Queue() for w in range(numWorkers)]
+    self.workers = [Process(target = self.work, args = (w,))
+                    for w in range(numWorkers)]
+
+    self.inputQueues = [node.dataQueue for node in brain.inputList]
+    for node in brain.inputList:
+      node.dataQueue = _Post(self.inboxes[self.assignment[node.ID]], node.ID)
+    return
+
+  #----------------------------------------------------------------------------
+  def start(self):
+    '''
+    Starts the worker processes.  They are daemons, so they end with the
+    program.
+    '''
+    for worker in self.workers:
+      worker.daemon = True
+      worker.start()
+    return
+
+  #----------------------------------------------------------------------------
+  def stop(self):
+    '''
+    Stops the worker processes with a poison pill, waits for them and gives
+    the InputNodes back their own dataQueues.
+    '''
+    for inbox in self.inboxes:
+      inbox.put(None)
+    for worker in self.workers:
+      worker.join()
+    for node, dataQueue in zip(self.brain.inputList, self.inputQueues):
+      node.dataQueue = dataQueue
+    return
+
+  #----------------------------------------------------------------------------
+  def crossEdges(self):
+    '''
+    Returns the number of connections between resources on different
+    workers.
+    '''
+    return sum(1 for R1, R2 in self.brain.E
+               if self.assignment[R1.ID] != self.assignment[R2.ID])
+
+  #----------------------------------------------------------------------------
+  def work(self, worker):
+    '''
+    The function each worker process runs.  It connects the resources of the
+    worker to each other through its deque and to the other workers through
+    their inboxes, then handles values until it reads None.
+    '''
+    local = deque() #(ID, item) for the resources of this worker
+    outboxes = [[] for w in range(self.numWorkers)] #(ID, item) for the others
+    resources = {}
+    for R in _resources(self.brain):
+      if self.assignment[R.ID] == worker:
+        resources[R.ID] = R
+
+    for R in resources.values():
+      if R.trace != None:
+        R.trace.pid.value = os.getpid()
+      for ID, output in getattr(R, 'outputList', {}).items():
+        w = self.assignment[ID]
+        if w == worker:
+          output['dataQueue'] = _Route(local, ID)
+        else:
+          output['dataQueue'] = _Route(outboxes[w], ID)
+        output['credit'] = None
+      for source in getattr(R, 'inputList', {}).values():
+        source['credit'] = None
+
+    inbox = self.inboxes[worker]
+    while True:
+      while local:
+        ID, item = local.popleft()
+        resources[ID].handle(item)
+
+      for w in range(self.numWorkers):
+        if outboxes[w]:
+          self.inboxes[w].put(outboxes[w][:])
+          del outboxes[w][:]
+
+      try:
+        messages = inbox.get(False)
+      except Empty:
+        for R in resources.values():
+          if isinstance(R, InputNode):
+            R.flushACK()
+        messages = inbox.get()
+      if messages == None: #The poison pill from stop()
+        break
+      local.extend(messages)
+    return
+
+#------------------------------------------------------------------------------
+class WorkerPool():
+  '''
+  A pool of worker processes which are started once and kept warm, so a
+  Brain can be run on them without starting any processes.  A Brain is bound
+  to the pool with Brain.start(pool = ...), and binding another Brain (or
+  the same one after it has been rebuilt) rebinds the running workers to
+  the new network.
+
+  The workers are given the network as plain data (see graphSpec()), build
+  their share of the resources and run them as a Scheduler's workers do.
+  The iteration and activation functions are pickled by name, so they must
+  be module level functions which the workers can import.  Python 2 has no
+  forkserver, so the pool is forked when it is made; make it early, before
+  the program grows large.
+  '''
+  #----------------------------------------------------------------------------
+  def __init__(self, numWorkers=None):
+    '''
+    (int)numWorkers: The number of worker processes.  The default is one per
+    core.
+    '''
+    if numWorkers == None:
+      numWorkers = cpu_count()
+    assert numWorkers > 0, 'numWorkers must be positive'
+    self.numWorkers = numWorkers
+    self.inboxes = [Queue() for w in range(numWorkers)]
+    self.dataQueue = Queue() #Outputs of the OutputNodes, for the Brain
+    self.readyQueue = Queue() #(worker, generation, error) after binding
+    self.generation = 0 #Counts the bindings
+    self.brain = None
+    self.saved = None #The Brain's own queues and credits while it is bound
+
+    self.workers = [Process(target = _poolWorker,
+                            args = (w, self.inboxes, self.dataQueue,
+                                    self.readyQueue))
+                    for w in range(numWorkers)]
+    for worker in self.workers:
+      worker.daemon = True
+      worker.start()
+    return
+
+  #----------------------------------------------------------------------------
+  def bind(self, brain):
+    '''
+    Builds the finished network of brain on the workers, replacing whatever
+    they were running, and points brain at them.  Raises a RuntimeError if
+    a worker cannot build its resources.
+    '''
+    if self.brain != None:
+      self._restore()
+    assignment = partition(brain, min(self.numWorkers,
+                                      len(_resources(brain))))
+    self._send(graphSpec(brain), assignment)
+
+    #Sequence numbers of each binding start at their own offset, so late
+    #outputs of an earlier network are dropped by Brain.collect()
+    self.brain = brain
+    self.saved = (brain.dataQueue,
+                  [(node.dataQueue, node.credit) for node in brain.inputList])
+    brain.dataQueue = self.dataQueue
+    brain.seqCount = self.generation << 32
+    for node in brain.inputList:
+      node.dataQueue = _Post(self.inboxes[assignment[node.ID]], node.ID,
+                             self.generation)
+      node.credit = None #The workers do not return the Brain's credits
+    return
+
+  #----------------------------------------------------------------------------
+  def unbind(self):
+    '''
+    Clears the network from the workers and gives the bound Brain back its
+    own queues and credits.  The workers keep running.
+    '''
+    if self.brain == None:
+      return
+    self._send(None, None)
+    self._restore()
+    return
+
+  #----------------------------------------------------------------------------
+  def close(self):
+    '''
+    Stops the worker processes with a poison pill and waits for them.
+    '''
+    self.unbind()
+    for inbox in self.inboxes:
+      inbox.put(None)
+    for worker in self.workers:
+      worker.join()
+    return
+
+#PRIVATE**********************************************************************
+  #----------------------------------------------------------------------------
+  def _send(self, spec, assignment):
+    '''
+    Sends a new network (or None) to every worker and waits until they have
+    all built it.
+    '''
+    self.generation += 1
+    for inbox in self.inboxes:
+      inbox.put(('bind', self.generation, spec, assignment))
+    errors = []
+    waiting = self.numWorkers
+    while waiting > 0:
+      worker, generation, error = self.readyQueue.get()
+      if generation == self.generation:
+        waiting -= 1
+        if error != None:
+          errors.append('worker %d: %s' %(worker, error))
+    if errors:
+      raise RuntimeError('Could not bind the network; ' + '; '.join(errors))
+    return
+
+  #----------------------------------------------------------------------------
+  def _restore(self):
+    '''
+    Gives the bound Brain back its own queues and credits, and marks it as
+    stopped.
+    '''
+    dataQueue, inputs = self.saved
+    self.brain.dataQueue = dataQueue
+    for node, (nodeQueue, credit) in zip(self.brain.inputList, inputs):
+      node.dataQueue = nodeQueue
+      node.credit = credit
+    self.brain.pool = None
+    self.brain.running = False
+    self.brain = None
+    self.saved = None
+    return
+
+#------------------------------------------------------------------------------
+def graphSpec(brain):
+  '''
+  Returns the network of brain as plain data which can be pickled: a dict
+  with 'resources', a list of (kind, ID, parameters) in the order
+  InputNodes, Links, Activators, OutputNodes, and 'edges', a list of
+  (ID, ID) connections.
+  '''
+  resources = []
+  for node in brain.inputList:
+    resources.append(('InputNode', node.ID, {'n': node.n}))
+  for L in brain.LinkList:
+    resources.append(('Link', L.ID, {'W': L.W, 'T': L.T}))
+  for A in brain.ActList:
+    resources.append(('Activator', A.ID,
+                      {'i': A.i, 'f': A.f, 'iterateMax': A.iterateMax,
+                       'theta': A.theta}))
+  for O in brain.outputList:
+    resources.append(('OutputNode', O.ID,
+                      {'i': O.i, 'f': O.f, 'iterateMax': O.iterateMax,
+                       'theta': O.theta, 'index': O.index}))
+  return {'resources': resources,
+          'edges': [(R1.ID, R2.ID) for R1, R2 in brain.E]}
+
+#------------------------------------------------------------------------------
+def partition(brain, numWorkers, passes=10, imbalance=0.05):
+  '''
+  Assigns the resources of brain to numWorkers workers, and returns a dict
+  of resource ID: worker.  Every worker gets about the same number of
+  resources, and connected resources are kept together where possible.
+
+  The resources are first put in breadth first order from the InputNodes,
+  which keeps neighbours close, and cut into numWorkers equal blocks.  Then
+  each pass moves any resource to the worker holding most of its neighbours,
+  if that lowers the number of connections between workers and leaves no
+  worker with more than (1 + imbalance) times its share.
+  '''
+  resources = _resources(brain)
+  neighbours = dict((R.ID, []) for R in resources)
+  for R1, R2 in brain.E:
+    neighbours[R1.ID].append(R2.ID)
+    neighbours[R2.ID].append(R1.ID)
+
+  order = []
+  seen = set()
+  for start in resources:
+    if start.ID in seen:
+      continue
+    seen.add(start.ID)
+    frontier = deque([start.ID])
+    while frontier:
+      ID = frontier.popleft()
+      order.append(ID)
+      for Rp in neighbours[ID]:
+        if not Rp in seen:
+          seen.add(Rp)
+          frontier.append(Rp)
+
+  assignment = {}
+  for k in range(len(order)):
+    assignment[order[k]] = k*numWorkers//len(order)
+  sizes = [0]*numWorkers
+  for w in assignment.values():
+    sizes[w] += 1
+  capacity = int(len(order)*(1 + imbalance)/numWorkers) + 1
+
+  for p in range(passes):
+    moved = False
+    for ID in order:
+      counts = [0]*numWorkers
+      for Rp in neighbours[ID]:
+        counts[assignment[Rp]] += 1
+      current = assignment[ID]
+      best = current
+      for w in range(numWorkers):
+        if sizes[w] < capacity and counts[w] > counts[best]:
+          best = w
+      if best != current and sizes[current] > 1:
+        assignment[ID] = best
+        sizes[current] -= 1
+        sizes[best] += 1
+        moved = True
+    if not moved:
+      break
+  return assignment
+
+#PRIVATE**********************************************************************
+#------------------------------------------------------------------------------
+class _Route():
+  '''
+  Stands in for the dataQueue of the resource ID in a worker: put() appends
+  (ID, item) to the worker's deque or to its list for another worker.
+  '''
+  def __init__(self, messages, ID):
+    self.messages = messages
+    self.ID = ID
+    return
+
+  def put(self, item):
+    self.messages.append((self.ID, item))
+    return
+
+#------------------------------------------------------------------------------
+class _Post():
+  '''
+  Stands in for the dataQueue of the InputNode ID in the Brain: put() sends
+  the input vector to the inbox of its worker, as a WorkerPool message of
+  the binding generation if there is one.
+  '''
+  def __init__(self, inbox, ID, generation=None):
+    self.inbox = inbox
+    self.ID = ID
+    self.generation = generation
+    return
+
+  def put(self, item):
+    if self.generation == None:
+      self.inbox.put([(self.ID, item)])
+    else:
+      self.inbox.put(('values', self.generation, [(self.ID, item)]))
+    return
+
+#------------------------------------------------------------------------------
+def _poolWorker(worker, inboxes, dataQueue, readyQueue):
+  '''
+  The function each WorkerPool process runs.  It handles ('bind',
+  generation, spec, assignment) messages by building its share of the
+  network, and ('values', generation, messages) by handling them if they
+  belong to the network it is running.  It returns when it reads None.
+  '''
+  local = deque()
+  outboxes = [[] for w in inboxes]
+  resources = {}
+  current = 0
+  inbox = inboxes[worker]
+  while True:
+    while local:
+      ID, item = local.popleft()
+      resources[ID].handle(item)
+
+    for w in range(len(inboxes)):
+      if outboxes[w]:
+        inboxes[w].put(('values', current, outboxes[w][:]))
+        del outboxes[w][:]
+
+    message = inbox.get()
+    if message == None: #The poison pill from WorkerPool.close()
+      break
+    if message[0] == 'bind':
+      current, spec, assignment = message[1:]
+      error = None
+      try:
+        resources = _build(spec, assignment, worker, local, outboxes,
+                           dataQueue)
+      except Exception as e:
+        resources = {}
+        error = repr(e)
+      readyQueue.put((worker, current, error))
+    elif message[1] == current:
+      local.extend(message[2])
+  return
+
+#------------------------------------------------------------------------------
+def _build(spec, assignment, worker, local, outboxes, dataQueue):
+  '''
+  Builds the resources of spec (from graphSpec()) assigned to worker, and
+  connects them through the worker's deque and outboxes.  Returns a dict of
+  ID: resource, which is empty if spec is None.
+  '''
+  resources = {}
+  if spec == None:
+    return resources
+  for kind, ID, p in spec['resources']:
+    if assignment[ID] != worker:
+      continue
+    if kind == 'InputNode':
+      R = InputNode(None, ID, None, p['n'])
+    elif kind == 'Link':
+      R = Link(p['W'], p['T'], None, ID)
+    elif kind == 'Activator':
+      R = Activator(p['i'], p['f'], None, ID, p['iterateMax'], p['theta'])
+    else:
+      R = OutputNode(p['i'], p['f'], None, ID, p['iterateMax'], p['theta'],
+                     p['index'], dataQueue)
+    resources[ID] = R
+
+  for ID1, ID2 in spec['edges']:
+    if ID1 in resources:
+      w = assignment[ID2]
+      if w == worker:
+        route = _Route(local, ID2)
+      else:
+        route = _Route(outboxes[w], ID2)
+      resources[ID1].outputList[ID2] = {'dataQueue': route,
+                                        'credit': None,
+                                        'credits': 0,
+                                        }
+    if ID2 in resources:
+      resources[ID2].inputList[ID1] = {'credit': None, 'pending': 0}
+  return resources
+
+#------------------------------------------------------------------------------
+def _resources(brain):
+  '''
+  Returns every resource of brain.
+  '''
+  return brain.inputList + brain.LinkList + brain.ActList + brain.outputList
@@ -0,0 +1,42 @@
+#Shared counters of the resources
+from multiprocessing.sharedctypes import RawArray
+import ctypes
+
+#The counters of a resource, in the order they are stored
+FIELDS = ('messagesIn', #Values (or input vectors) handled
+          'messagesOut', #Values pushed to other resources or the Brain
+          'creditWait', #Seconds spent waiting for credits to push
+          'iterateTime', #Seconds spent in the iteration function i
+          'activateTime', #Seconds spent in the activation function f
+          'queueHighWater', #Most items seen waiting in the dataQueue
+         )
+IN, OUT, WAIT, ITERATE, ACTIVATE, DEPTH = range(len(FIELDS))
+
+#------------------------------------------------------------------------------
+class Counters():
+  '''
+  The counters of one resource, in shared memory so the Brain can read them
+  while the resource processes are running.  Only the resource writes its
+  counters, so no lock is taken; a read may be a message behind.  Made
+  before the resource processes are started, so they inherit it.
+  '''
+  #----------------------------------------------------------------------------
+  def __init__(self):
+    self.values = RawArray(ctypes.c_double, len(FIELDS))
+    return
+
+  #----------------------------------------------------------------------------
+  def toDict(self):
+    '''
+    Returns a dict of field name: value.
+    '''
+    return dict(zip(FIELDS, self.values[:]))
+
+  #----------------------------------------------------------------------------
+  def reset(self):
+    '''
+    Sets every counter to 0.
+    '''
+    for k in range(len(FIELDS)):
+      self.values[k] = 0.0
+    return
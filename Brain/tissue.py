@@ -1,5 +1,8 @@
 #Parallel implementation
 from multiprocessing import Queue, Lock, Event
+from Queue import Empty
+from stats import Counters, IN, OUT, WAIT, ITERATE, ACTIVATE, DEPTH
+from trace import HANDLE, PUSH, CREDIT, FIRE, STALL
 import os, time
 
 #------------------------------------------------------------------------------
@@ -8,25 +11,21 @@ class Link():
   The Link resource.  It is connected to and from nodes and other Links.
   '''
   #----------------------------------------------------------------------------
-  def __init__(self, W, T, ACKCount, ACKEvent, ACKMax, dataQueue,
-               ID):
+  def __init__(self, W, T, dataQueue, ID, creditBatch=1, trace=None):
     '''
     (float)W: A weight a the affine transform Wx + T
     (float)T: T A weight a the affine transform Wx + T
     (int)ID: To identify different processes
+    (int)creditBatch: The number of values read from an input before its
+    credits are given back
+    (TraceBuffer)trace: Where to record trace events, or None
     -> All of the following are from the multiprocessing module
-    (Value)ACKCount: A counter for the number of acknowledgements
-    (Event)ACKEvent: An event for when ACKCount = ACKMax
-    (Value)ACKMax: The number of output connections.  ie, number of ACKs to get
     (Queue)dataQueue: A queue for data input
-    (Event)queueEvent: An event for when the dataQueue is not empty
     '''
     assert isinstance(W, float), 'W must be an float'
     assert isinstance(T, float), 'T must be a float'
 
-    self.ACKCount = ACKCount
-    self.ACKEvent = ACKEvent
-    self.ACKMax = ACKMax #This needs to be set to len(outputList)
+    self.creditBatch = creditBatch
 
     self.dataQueue = dataQueue
 
@@ -38,6 +37,8 @@ class Link():
 
     self.PID = 0
     self.ID = ID
+    self.counters = Counters()
+    self.trace = trace
     return
 
   #----------------------------------------------------------------------------
@@ -51,66 +52,138 @@ class Link():
     '''
     This is the function that will run as a seperate process.  Everything
     else in the class just access data.  Call this function when
-    everything is connected and finalized.
+    everything is connected and finalized.  It returns when it reads None.
     '''
     self.PID = os.getpid()
+    if self.trace != None:
+      self.trace.pid.value = self.PID
     while True:
-      x, ID = self.dataQueue.get()
-      print '%s Got queue data (%f, %s)' %(self.ID, x, ID)
-      self.ACK(ID)
-      xp = self.W*x + self.T
-      assert self.ACKCount.value == 0, 'ACKCount not 0 prior to outputting'
-      for ID in self.outputList:
-        self.push(xp, ID)
-      if self.ACKMax.value > 0:
-        self.ACKEvent.wait()
-        print '%s Got all ACK' %self.ID
-        self.ACKEvent.clear()
+      item = self.receive()
+      if item == None: #The poison pill from Brain.stop()
+        break
+      self.handle(item)
+    return
+
+  #----------------------------------------------------------------------------
+  def handle(self, item):
+    '''
+    Handles one (x, ID, seq) value from the resource ID.  activate() calls
+    this for every item read from the dataQueue, and a scheduler.Scheduler
+    worker calls it directly.
+    '''
+    x, ID, seq = item
+    start = time.time()
+    self.counters.values[IN] += 1
+    self.ACK(ID)
+    xp = self.W*x + self.T
+    for ID in self.outputList:
+      self.push(xp, ID, seq)
+    if self.trace != None:
+      self.trace.record(HANDLE, seq, item[1], start = start)
     return
 
   #----------------------------------------------------------------------------
-  def appendOutput(self, R):
+  def appendOutput(self, R, credit):
     '''
-    Simply appends the resource R to the outputList.
+    Simply appends the resource R to the outputList, with the Credit of the
+    edge to it.
     '''
-    self.outputList[R.ID] = {'dataQueue': R.dataQueue}
+    self.outputList[R.ID] = {'dataQueue': R.dataQueue,
+                             'credit': credit,
+                             'credits': 0, #Credits taken but not yet spent
+                             }
     return
 
   #----------------------------------------------------------------------------
-  def appendInput(self, R):
+  def appendInput(self, R, credit):
     '''
-    Simply appends the resource R to the inputList.
+    Simply appends the resource R to the inputList, with the Credit of the
+    edge from it.
     '''
-    self.inputList[R.ID] = {'ACKCount': R.ACKCount,
-                            'ACKEvent': R.ACKEvent,
-                            'ACKMax': R.ACKMax,
+    self.inputList[R.ID] = {'credit': credit,
+                            'pending': 0, #Values read but not yet acknowledged
                             }
     return
 
   #----------------------------------------------------------------------------
-  def push(self, x, ID):
+  def push(self, x, ID, seq):
     '''
-    Pushes the value x to ID's dataQueue
+    Pushes the value x to ID's dataQueue, tagged with the sequence number
+    seq of the input vector it belongs to
     '''
     if not ID in self.outputList:
       raise RuntimeError('%s is not in the outputList' %ID)
     else:
-      self.outputList[ID]['dataQueue'].put((x, self.ID))
+      output = self.outputList[ID]
+      if output['credit'] != None: #No Credit means no flow control
+        if output['credits'] == 0:
+          output['credits'] = output['credit'].take(False)
+          if output['credits'] == 0:
+            #About to wait, so first give back the credits this resource holds
+            start = time.time()
+            self.flushACK()
+            output['credits'] = output['credit'].take()
+            self.counters.values[WAIT] += time.time() - start
+            if self.trace != None:
+              self.trace.record(STALL, seq, ID, start = start)
+        output['credits'] -= 1
+      if self.trace != None:
+        self.trace.record(PUSH, seq, ID)
+      output['dataQueue'].put((x, self.ID, seq))
+      self.counters.values[OUT] += 1
     return
 
+  #----------------------------------------------------------------------------
+  def receive(self):
+    '''
+    Returns the next (x, ID, seq) from the dataQueue.  If it is empty, the
+    credits not yet given back are flushed before waiting, since the senders
+    may be waiting for them.
+    Otherwise the number of items waiting is checked against the
+    queueHighWater counter.
+    '''
+    try:
+      item = self.dataQueue.get(False)
+    except Empty:
+      self.flushACK()
+      return self.dataQueue.get()
+    try:
+      depth = self.dataQueue.qsize() + 1
+      if depth > self.counters.values[DEPTH]:
+        self.counters.values[DEPTH] = depth
+    except NotImplementedError: #qsize() is missing on Mac OS X
+      pass
+    return item
+
   #----------------------------------------------------------------------------
   def ACK(self, ID):
     '''
+    Acknowledges a value from ID.  The credits are given back to ID once
+    creditBatch values from it have been read.
     '''
     if not ID in self.inputList:
       raise RuntimeError('%s is not in the inputList' %ID)
     else:
-      with self.inputList[ID]['ACKCount'].get_lock():
-        self.inputList[ID]['ACKCount'].value += 1
-        if (self.inputList[ID]['ACKCount'].value ==
-            self.inputList[ID]['ACKMax'].value):
-          self.inputList[ID]['ACKCount'].value = 0
-          self.inputList[ID]['ACKEvent'].set()
+      source = self.inputList[ID]
+      source['pending'] += 1
+      if source['credit'] != None and source['pending'] >= self.creditBatch:
+        if self.trace != None:
+          self.trace.record(CREDIT, -1, ID, source['pending'])
+        source['credit'].give(source['pending'])
+        source['pending'] = 0
+    return
+
+  #----------------------------------------------------------------------------
+  def flushACK(self):
+    '''
+    Gives back the credits of every value read but not yet acknowledged.
+    '''
+    for ID, source in self.inputList.items():
+      if source['credit'] != None and source['pending'] > 0:
+        if self.trace != None:
+          self.trace.record(CREDIT, -1, ID, source['pending'])
+        source['credit'].give(source['pending'])
+        source['pending'] = 0
     return
 
 #------------------------------------------------------------------------------
@@ -119,25 +192,23 @@ class Activator():
   The Activator resource.  It is connected to and from Links.
   '''
   #----------------------------------------------------------------------------
-  def __init__(self, i, f, ACKCount, ACKEvent, ACKMax, dataQueue,
-               ID, iterateMax, theta):
+  def __init__(self, i, f, dataQueue, ID, iterateMax, theta, creditBatch=1,
+               trace=None):
     '''
     (function)i: The iteration function
     (function)f: The activation function
     (int)ID: To identify different processes
+    (int)creditBatch: The number of values read from an input before its
+    credits are given back
+    (TraceBuffer)trace: Where to record trace events, or None
     -> All of the following are from the multiprocessing module
-    (Value)ACKCount: A counter for the number of acknowledgements
-    (Event)ACKEvent: An event for when ACKCount = ACKMax
-    (Value)ACKMax: The number of output connections.  ie, number of ACKs to get
     (Queue)dataQueue: A queue for data input
     '''
     assert hasattr(i, '__call__'), 'i must be a function'
     assert hasattr(f, '__call__'), 'f must be a function'
     assert isinstance(theta, float), 'theta must be a float'
 
-    self.ACKCount = ACKCount
-    self.ACKEvent = ACKEvent
-    self.ACKMax = ACKMax
+    self.creditBatch = creditBatch
 
     self.dataQueue = dataQueue
 
@@ -148,11 +219,13 @@ class Activator():
     self.f = f
 
     self.iterateMax = iterateMax
-    self.iterateCount = 0
+    self.partial = {} #seq: [x, iterateCount] for each input vector in flight
     self.x = theta
     self.theta = theta
     self.PID = 0
     self.ID = ID
+    self.counters = Counters()
+    self.trace = trace
     return
 
   #----------------------------------------------------------------------------
@@ -166,74 +239,167 @@ class Activator():
     '''
     This is the function that will run as a seperate process.  Everything
     else in the class just access data.  Call this function when
-    everything is connected and finalized.
+    everything is connected and finalized.  It returns when it reads None.
     '''
     self.PID = os.getpid()
+    if self.trace != None:
+      self.trace.pid.value = self.PID
     while True:
-      x, ID = self.dataQueue.get()
-      print '%s Got queue data (%f, %s)' %(self.ID, x, ID)
-      self.ACK(ID)
-      self.x = self.i(self.x, x)
-      self.iterateCount += 1
-      if self.iterateCount == self.iterateMax:
-        xp = self.f(self.x)
-        self.iterateCount = 0
-        self.x = self.theta
-        assert self.ACKCount.value == 0, 'ACKCount not 0 prior to outputting'
-        for ID in self.outputList:
-          print '%s pushing %f to ID %s' %(self.ID, xp, ID)
-          self.push(xp, ID)
-        if self.ACKMax.value > 0:
-          self.ACKEvent.wait()
-          print '%s Got all ACK' %self.ID
-          self.ACKEvent.clear()
+      item = self.receive()
+      if item == None: #The poison pill from Brain.stop()
+        break
+      self.handle(item)
+    return
+
+  #----------------------------------------------------------------------------
+  def handle(self, item):
+    '''
+    Handles one (x, ID, seq) value from the resource ID.  activate() calls
+    this for every item read from the dataQueue, and a scheduler.Scheduler
+    worker calls it directly.
+    '''
+    x, ID, seq = item
+    start = time.time()
+    self.counters.values[IN] += 1
+    self.ACK(ID)
+    xp = self.iterate(x, seq)
+    if xp != None:
+      if self.trace != None:
+        self.trace.record(FIRE, seq, value = xp)
+      for ID in self.outputList:
+        self.push(xp, ID, seq)
+    if self.trace != None:
+      self.trace.record(HANDLE, seq, item[1], start = start)
     return
 
   #----------------------------------------------------------------------------
-  def appendOutput(self, R):
+  def iterate(self, x, seq):
+    '''
+    Applies the iteration function to x and the running value of input
+    vector seq.  Returns f() of the running value once iterateMax values of
+    that vector have been received, otherwise None.  Each input vector has
+    its own running value, so several can be in the network at once.
+    '''
+    state = self.partial.get(seq)
+    if state == None:
+      state = self.partial[seq] = [self.theta, 0]
+    counters = self.counters.values
+    start = time.time()
+    state[0] = self.i(state[0], x)
+    counters[ITERATE] += time.time() - start
+    state[1] += 1
+    if state[1] < self.iterateMax:
+      return None
+    del self.partial[seq]
+    start = time.time()
+    xp = self.f(state[0])
+    counters[ACTIVATE] += time.time() - start
+    return xp
+
+  #----------------------------------------------------------------------------
+  def appendOutput(self, R, credit):
     '''
-    Simply appends the resource R to the outputList.
+    Simply appends the resource R to the outputList, with the Credit of the
+    edge to it.
     '''
     assert isinstance(R, Link), 'R must be a Link'
-    self.outputList[R.ID] = {'dataQueue': R.dataQueue}
+    self.outputList[R.ID] = {'dataQueue': R.dataQueue,
+                             'credit': credit,
+                             'credits': 0, #Credits taken but not yet spent
+                             }
     return
 
   #----------------------------------------------------------------------------
-  def appendInput(self, R):
+  def appendInput(self, R, credit):
     '''
-    Simply appends the resource R to the inputList. 
+    Simply appends the resource R to the inputList, with the Credit of the
+    edge from it.
     '''
     assert isinstance(R, Link), 'R must be a Link'
-    self.inputList[R.ID] = {'ACKCount': R.ACKCount,
-                            'ACKEvent': R.ACKEvent,
-                            'ACKMax': R.ACKMax,
+    self.inputList[R.ID] = {'credit': credit,
+                            'pending': 0, #Values read but not yet acknowledged
                             }
     return
 
   #----------------------------------------------------------------------------
-  def push(self, x, ID):
+  def push(self, x, ID, seq):
     '''
-    Pushes the value x to ID's dataQueue
+    Pushes the value x to ID's dataQueue, tagged with the sequence number
+    seq of the input vector it belongs to
     '''
     if not ID in self.outputList:
       raise RuntimeError('%s is not in the outputList' %ID)
     else:
-      self.outputList[ID]['dataQueue'].put((x, self.ID))
+      output = self.outputList[ID]
+      if output['credit'] != None: #No Credit means no flow control
+        if output['credits'] == 0:
+          output['credits'] = output['credit'].take(False)
+          if output['credits'] == 0:
+            #About to wait, so first give back the credits this resource holds
+            start = time.time()
+            self.flushACK()
+            output['credits'] = output['credit'].take()
+            self.counters.values[WAIT] += time.time() - start
+            if self.trace != None:
+              self.trace.record(STALL, seq, ID, start = start)
+        output['credits'] -= 1
+      if self.trace != None:
+        self.trace.record(PUSH, seq, ID)
+      output['dataQueue'].put((x, self.ID, seq))
+      self.counters.values[OUT] += 1
     return
 
+  #----------------------------------------------------------------------------
+  def receive(self):
+    '''
+    Returns the next (x, ID, seq) from the dataQueue.  If it is empty, the
+    credits not yet given back are flushed before waiting, since the senders
+    may be waiting for them.
+    Otherwise the number of items waiting is checked against the
+    queueHighWater counter.
+    '''
+    try:
+      item = self.dataQueue.get(False)
+    except Empty:
+      self.flushACK()
+      return self.dataQueue.get()
+    try:
+      depth = self.dataQueue.qsize() + 1
+      if depth > self.counters.values[DEPTH]:
+        self.counters.values[DEPTH] = depth
+    except NotImplementedError: #qsize() is missing on Mac OS X
+      pass
+    return item
+
   #----------------------------------------------------------------------------
   def ACK(self, ID):
     '''
+    Acknowledges a value from ID.  The credits are given back to ID once
+    creditBatch values from it have been read.
     '''
     if not ID in self.inputList:
       raise RuntimeError('%s is not in the inputList' %ID)
     else:
-      with self.inputList[ID]['ACKCount'].get_lock():
-        self.inputList[ID]['ACKCount'].value += 1
-        if (self.inputList[ID]['ACKCount'].value ==
-            self.inputList[ID]['ACKMax'].value):
-          self.inputList[ID]['ACKCount'].value = 0
-          self.inputList[ID]['ACKEvent'].set()
+      source = self.inputList[ID]
+      source['pending'] += 1
+      if source['credit'] != None and source['pending'] >= self.creditBatch:
+        if self.trace != None:
+          self.trace.record(CREDIT, -1, ID, source['pending'])
+        source['credit'].give(source['pending'])
+        source['pending'] = 0
+    return
+
+  #----------------------------------------------------------------------------
+  def flushACK(self):
+    '''
+    Gives back the credits of every value read but not yet acknowledged.
+    '''
+    for ID, source in self.inputList.items():
+      if source['credit'] != None and source['pending'] > 0:
+        if self.trace != None:
+          self.trace.record(CREDIT, -1, ID, source['pending'])
+        source['credit'].give(source['pending'])
+        source['pending'] = 0
     return
 
 #------------------------------------------------------------------------------
@@ -242,28 +408,21 @@ class InputNode():
   The InputNode resource.  It is connected from the Brain to a link.
   '''
   #----------------------------------------------------------------------------
-  def __init__(self, ACKCount, ACKEvent, ACKMax, dataQueue,
-               ID, brainACKCount, brainACKEvent, brainACKMax,
-               n):
+  def __init__(self, dataQueue, ID, credit, n, creditBatch=1, trace=None):
     '''
     (int)ID: To identify different processes
+    (Credit)credit: The credits of the Brain for this InputNode.  There is
+    one per InputNode, so they do not share a lock.
     (int)n: The number of inputs to the node for each NN input vector
+    (int)creditBatch: The number of input vectors read before the Brain's
+    credits are given back
+    (TraceBuffer)trace: Where to record trace events, or None
     -> All of the following are from the multiprocessing module
-    (Value)ACKCount: A counter for the number of acknowledgements
-    (Event)ACKEvent: An event for when ACKCount = ACKMax
-    (Value)ACKMax: The number of output connections.  ie, number of ACKs to get
     (Queue)dataQueue: A queue for data input
-    (Value)brainACKCount: The Brain's ACK counter
-    (Event)brainACKEvent: The Brain's ACK Event
-    (Value)brainACKMax: The Brains's max ACK counter
     '''
-    self.ACKCount = ACKCount
-    self.ACKEvent = ACKEvent
-    self.ACKMax = ACKMax
-
-    self.brainACKCount = brainACKCount
-    self.brainACKEvent = brainACKEvent
-    self.brainACKMax = brainACKMax
+    self.credit = credit
+    self.pending = 0 #Input vectors read but not yet acknowledged
+    self.creditBatch = creditBatch
 
     self.dataQueue = dataQueue
 
@@ -272,6 +431,8 @@ class InputNode():
     self.n = n
     self.PID = 0
     self.ID = ID
+    self.counters = Counters()
+    self.trace = trace
     return
 
   #----------------------------------------------------------------------------
@@ -285,54 +446,125 @@ class InputNode():
     '''
     This is the function that will run as a seperate process.  Everything
     else in the class just access data.  Call this function when
-    everything is connected and finalized.
+    everything is connected and finalized.  It returns when it reads None.
     '''
     self.PID = os.getpid()
+    if self.trace != None:
+      self.trace.pid.value = self.PID
     while True:
-      X = self.dataQueue.get() #X will be a tuple of values
-      if len(X) != self.n:
-        raise ValueError('Input X must have length %d' %self.n)
-      print '%s Got queue data ' %self.ID + str(X)
-      self.ACK()
-      for x in X:
-        assert self.ACKCount.value == 0, 'ACKCount not 0 prior to outputting'
-        print '%s outputting %f' %(self.ID, x)
-        for ID in self.outputList:
-          self.push(x, ID)
-        self.ACKEvent.wait()
-        print '%s Got all ACK' %self.ID
-        self.ACKEvent.clear()
+      item = self.receive()
+      if item == None: #The poison pill from Brain.stop()
+        break
+      self.handle(item)
+    return
+
+  #----------------------------------------------------------------------------
+  def handle(self, item):
+    '''
+    Handles one (X, seq) input vector from the Brain.  activate() calls
+    this for every item read from the dataQueue, and a scheduler.Scheduler
+    worker calls it directly.
+    '''
+    X, seq = item #X will be a tuple of values
+    if len(X) != self.n:
+      raise ValueError('Input X must have length %d' %self.n)
+    start = time.time()
+    self.counters.values[IN] += 1
+    self.ACK()
+    for x in X:
+      for ID in self.outputList:
+        self.push(x, ID, seq)
+    if self.trace != None:
+      self.trace.record(HANDLE, seq, start = start)
     return
 
   #----------------------------------------------------------------------------
-  def appendOutput(self, R):
+  def appendOutput(self, R, credit):
     '''
-    Simply appends the resource R to the outputList.
+    Simply appends the resource R to the outputList, with the Credit of the
+    edge to it.
     '''
     assert isinstance(R, Link), 'R must be a Link'
-    self.outputList[R.ID] = {'dataQueue': R.dataQueue}
+    self.outputList[R.ID] = {'dataQueue': R.dataQueue,
+                             'credit': credit,
+                             'credits': 0, #Credits taken but not yet spent
+                             }
     return
 
   #----------------------------------------------------------------------------
-  def push(self, x, ID):
+  def push(self, x, ID, seq):
     '''
-    Pushes the value x to ID's dataQueue
+    Pushes the value x to ID's dataQueue, tagged with the sequence number
+    seq of the input vector it belongs to
     '''
     if not ID in self.outputList:
       raise RuntimeError('%s is not in the outputList' %ID)
     else:
-      self.outputList[ID]['dataQueue'].put((x, self.ID))
+      output = self.outputList[ID]
+      if output['credit'] != None: #No Credit means no flow control
+        if output['credits'] == 0:
+          output['credits'] = output['credit'].take(False)
+          if output['credits'] == 0:
+            #About to wait, so first give back the credits this resource holds
+            start = time.time()
+            self.flushACK()
+            output['credits'] = output['credit'].take()
+            self.counters.values[WAIT] += time.time() - start
+            if self.trace != None:
+              self.trace.record(STALL, seq, ID, start = start)
+        output['credits'] -= 1
+      if self.trace != None:
+        self.trace.record(PUSH, seq, ID)
+      output['dataQueue'].put((x, self.ID, seq))
+      self.counters.values[OUT] += 1
     return
 
+  #----------------------------------------------------------------------------
+  def receive(self):
+    '''
+    Returns the next (X, seq) from the dataQueue.  If it is empty, the
+    Brain's credits not yet given back are flushed before waiting.
+    Otherwise the number of items waiting is checked against the
+    queueHighWater counter.
+    '''
+    try:
+      item = self.dataQueue.get(False)
+    except Empty:
+      self.flushACK()
+      return self.dataQueue.get()
+    try:
+      depth = self.dataQueue.qsize() + 1
+      if depth > self.counters.values[DEPTH]:
+        self.counters.values[DEPTH] = depth
+    except NotImplementedError: #qsize() is missing on Mac OS X
+      pass
+    return item
+
   #----------------------------------------------------------------------------
   def ACK(self):
     '''
+    Acknowledges an input vector from the Brain.  The credits are given back
+    once creditBatch input vectors have been read.
+    '''
+    self.pending += 1
+    if self.credit != None and self.pending >= self.creditBatch:
+      if self.trace != None:
+        self.trace.record(CREDIT, -1, value = self.pending)
+      self.credit.give(self.pending)
+      self.pending = 0
+    return
+
+  #----------------------------------------------------------------------------
+  def flushACK(self):
+    '''
+    Gives back the Brain's credits of every input vector read but not yet
+    acknowledged.
     '''
-    with self.brainACKCount.get_lock():
-      self.brainACKCount.value += self.n
-      if (self.brainACKCount.value == self.brainACKMax.value):
-        self.brainACKCount = 0
-        self.brainACKEvent.set()
+    if self.credit != None and self.pending > 0:
+      if self.trace != None:
+        self.trace.record(CREDIT, -1, value = self.pending)
+      self.credit.give(self.pending)
+      self.pending = 0
     return
 
 #------------------------------------------------------------------------------
@@ -341,8 +573,8 @@ class OutputNode():
   The OutputNode resource.  It is connected from a Link to the Brain
   '''
   #----------------------------------------------------------------------------
-  def __init__(self, i, f, ACKEvent, dataQueue, ID, iterateMax, theta,
-               index, brainDataQueue):
+  def __init__(self, i, f, dataQueue, ID, iterateMax, theta, index,
+               brainDataQueue, creditBatch=1, trace=None):
     '''
     (function)i: The iteration function
     (function)f: The activation function
@@ -350,15 +582,17 @@ class OutputNode():
     (int)index: The index of this output node in the Brain's list.  It is
     returned with the value computed so the Brain can properly assemble the
     output vector
+    (int)creditBatch: The number of values read from an input before its
+    credits are given back
+    (TraceBuffer)trace: Where to record trace events, or None
     -> All of the following are from the multiprocessing module
-    (Event)ACKEvent: An event for when ACKCount = ACKMax
     (Queue)dataQueue: A queue for data input
     (Queue)brainDataQueue: The Brain's Queue for data
     '''
     assert hasattr(i, '__call__'), 'i must be a function'
     assert hasattr(f, '__call__'), 'f must be a function'
 
-    self.ACKEvent = ACKEvent
+    self.creditBatch = creditBatch
 
     self.dataQueue = dataQueue
     self.brainDataQueue = brainDataQueue
@@ -370,11 +604,13 @@ class OutputNode():
 
     self.index = index
     self.iterateMax = iterateMax
-    self.iterateCount = 0
+    self.partial = {} #seq: [x, iterateCount] for each input vector in flight
     self.x = theta
     self.theta = theta
     self.PID = 0
     self.ID = ID
+    self.counters = Counters()
+    self.trace = trace
 
     return
 
@@ -389,57 +625,134 @@ class OutputNode():
     '''
     This is the function that will run as a seperate process.  Everything
     else in the class just access data.  Call this function when
-    everything is connected and finalized.
+    everything is connected and finalized.  It returns when it reads None.
     '''
     self.PID = os.getpid()
+    if self.trace != None:
+      self.trace.pid.value = self.PID
     while True:
-      x, ID = self.dataQueue.get()
-      print '%s Got queue data (%f, %s)' %(self.ID, x, ID)
-      self.ACK(ID)
-      self.x = self.i(self.x, x)
-      self.iterateCount += 1
-      if self.iterateCount == self.iterateMax:
-        xp = self.f(self.x)
-        self.iterateCount = 0
-        self.x = self.theta
-        print '%s outputting %f' %(self.ID, xp)
-        self.push(xp)
-        self.ACKEvent.wait()
-        print '%s Got all ACK' %self.ID
-        self.ACKEvent.clear()
+      item = self.receive()
+      if item == None: #The poison pill from Brain.stop()
+        break
+      self.handle(item)
     return
 
   #----------------------------------------------------------------------------
-  def appendInput(self, R):
+  def handle(self, item):
+    '''
+    Handles one (x, ID, seq) value from the resource ID.  activate() calls
+    this for every item read from the dataQueue, and a scheduler.Scheduler
+    worker calls it directly.
+    '''
+    x, ID, seq = item
+    start = time.time()
+    self.counters.values[IN] += 1
+    self.ACK(ID)
+    xp = self.iterate(x, seq)
+    if xp != None:
+      if self.trace != None:
+        self.trace.record(FIRE, seq, value = xp)
+      self.push(xp, seq)
+    if self.trace != None:
+      self.trace.record(HANDLE, seq, item[1], start = start)
+    return
+
+  #----------------------------------------------------------------------------
+  def iterate(self, x, seq):
+    '''
+    Applies the iteration function to x and the running value of input
+    vector seq.  Returns f() of the running value once iterateMax values of
+    that vector have been received, otherwise None.
+    '''
+    state = self.partial.get(seq)
+    if state == None:
+      state = self.partial[seq] = [self.theta, 0]
+    counters = self.counters.values
+    start = time.time()
+    state[0] = self.i(state[0], x)
+    counters[ITERATE] += time.time() - start
+    state[1] += 1
+    if state[1] < self.iterateMax:
+      return None
+    del self.partial[seq]
+    start = time.time()
+    xp = self.f(state[0])
+    counters[ACTIVATE] += time.time() - start
+    return xp
+
+  #----------------------------------------------------------------------------
+  def appendInput(self, R, credit):
     '''
-    Simply appends the resource R to the inputList.
+    Simply appends the resource R to the inputList, with the Credit of the
+    edge from it.
     '''
     assert isinstance(R, Link), 'R must be a Link'
-    self.inputList[R.ID] = {'ACKCount': R.ACKCount,
-                            'ACKEvent': R.ACKEvent,
-                            'ACKMax': R.ACKMax,
+    self.inputList[R.ID] = {'credit': credit,
+                            'pending': 0, #Values read but not yet acknowledged
                             }
     return
 
   #----------------------------------------------------------------------------
-  def push(self, x):
+  def push(self, x, seq):
     '''
-    Pushes the value x to the Brain
+    Pushes the value x to the Brain, with the sequence number seq of the
+    input vector it belongs to
     '''
-    self.brainDataQueue.put((x, self.index))
+    if self.trace != None:
+      self.trace.record(PUSH, seq)
+    self.brainDataQueue.put((x, self.index, seq))
+    self.counters.values[OUT] += 1
     return
 
+  #----------------------------------------------------------------------------
+  def receive(self):
+    '''
+    Returns the next (x, ID, seq) from the dataQueue.  If it is empty, the
+    credits not yet given back are flushed before waiting, since the senders
+    may be waiting for them.
+    Otherwise the number of items waiting is checked against the
+    queueHighWater counter.
+    '''
+    try:
+      item = self.dataQueue.get(False)
+    except Empty:
+      self.flushACK()
+      return self.dataQueue.get()
+    try:
+      depth = self.dataQueue.qsize() + 1
+      if depth > self.counters.values[DEPTH]:
+        self.counters.values[DEPTH] = depth
+    except NotImplementedError: #qsize() is missing on Mac OS X
+      pass
+    return item
+
   #----------------------------------------------------------------------------
   def ACK(self, ID):
     '''
+    Acknowledges a value from ID.  The credits are given back to ID once
+    creditBatch values from it have been read.
     '''
     if not ID in self.inputList:
       raise RuntimeError('%s is not in the inputList' %ID)
     else:
-      with self.inputList[ID]['ACKCount'].get_lock():
-        self.inputList[ID]['ACKCount'].value += 1
-        if (self.inputList[ID]['ACKCount'].value ==
-            self.inputList[ID]['ACKMax'].value):
-          self.inputList[ID]['ACKCount'].value = 0
-          self.inputList[ID]['ACKEvent'].set()
+      source = self.inputList[ID]
+      source['pending'] += 1
+      if source['credit'] != None and source['pending'] >= self.creditBatch:
+        if self.trace != None:
+          self.trace.record(CREDIT, -1, ID, source['pending'])
+        source['credit'].give(source['pending'])
+        source['pending'] = 0
+    return
+
+  #----------------------------------------------------------------------------
+  def flushACK(self):
+    '''
+    Gives back the credits of every value read but not yet acknowledged.
+    '''
+    for ID, source in self.inputList.items():
+      if source['credit'] != None and source['pending'] > 0:
+        if self.trace != None:
+          self.trace.record(CREDIT, -1, ID, source['pending'])
+        source['credit'].give(source['pending'])
+        source['pending'] = 0
     return
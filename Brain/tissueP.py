@@ -57,7 +57,6 @@ class Link():
     self.PID = os.getpid()
     while True:
       x, ID = self.dataQueue.get()
-      print '%s Got queue data (%f, %d)' %(self.name, x, ID)
       self.ACK(ID)
       xp = self.W*x + self.T
       assert self.ACKCount.value == 0, 'ACKCount not 0 prior to outputting'
@@ -65,7 +64,6 @@ class Link():
         self.push(xp, ID)
       if self.ACKMax.value > 0:
         self.ACKEvent.wait()
-        print '%s Got all ACK' %self.name
         self.ACKEvent.clear()
     return
 
@@ -173,7 +171,6 @@ class Activator():
     self.PID = os.getpid()
     while True:
       x, ID = self.dataQueue.get()
-      print '%s Got queue data (%f, %d)' %(self.name, x, ID)
       self.ACK(ID)
       self.x = self.i(self.x, x)
       self.iterateCount += 1
@@ -183,11 +180,9 @@ class Activator():
         self.x = self.theta
         assert self.ACKCount.value == 0, 'ACKCount not 0 prior to outputting'
         for ID in self.outputList:
-          print '%s pushing %f to ID %d' %(self.name, xp, ID)
           self.push(xp, ID)
         if self.ACKMax.value > 0:
           self.ACKEvent.wait()
-          print '%s Got all ACK' %self.name
           self.ACKEvent.clear()
     return
 
@@ -293,15 +288,12 @@ class InputNode():
     self.PID = os.getpid()
     while True:
       X = self.dataQueue.get() #X will be a tuple of values
-      print '%s Got queue data ' %self.name + str(X)
       self.ACK()
       for x in X:
         assert self.ACKCount.value == 0, 'ACKCount not 0 prior to outputting'
-        print '%s outputting %f' %(self.name, x)
         for ID in self.outputList:
           self.push(x, ID)
         self.ACKEvent.wait()
-        print '%s Got all ACK' %self.name
         self.ACKEvent.clear()
     return
 
@@ -396,7 +388,6 @@ class OutputNode():
     self.PID = os.getpid()
     while True:
       x, ID = self.dataQueue.get()
-      print '%s Got queue data (%f, %d)' %(self.name, x, ID)
       self.ACK(ID)
       self.x = self.i(self.x, x)
       self.iterateCount += 1
@@ -404,10 +395,8 @@ class OutputNode():
         xp = self.f(self.x)
         self.iterateCount = 0
         self.x = self.theta
-        print '%s outputting %f' %(self.name, xp)
         self.push(xp)
         self.ACKEvent.wait()
-        print '%s Got all ACK' %self.name
         self.ACKEvent.clear()
     return
 
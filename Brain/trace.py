@@ -0,0 +1,158 @@
+#Timeline traces of the values passed between resources
+from multiprocessing.sharedctypes import RawArray, RawValue
+import ctypes, json, os, time
+
+from channel import ID_SIZE
+
+#The kinds of trace events
+HANDLE = 0 #A value (or input vector) handled, from peer, for dur seconds
+PUSH = 1 #A value pushed to peer
+CREDIT = 2 #value credits given back to peer
+FIRE = 3 #The activation function fired, giving value
+STALL = 4 #Waited dur seconds for credits to push to peer
+KINDS = ('handle', 'push', 'credit', 'fire', 'creditWait')
+
+#------------------------------------------------------------------------------
+class TraceBuffer():
+  '''
+  A fixed size ring of trace events for one resource, in shared memory so
+  the Brain can export it while the resource processes run.  Once it is full
+  the oldest events are overwritten, so tracing can be left on.  Only the
+  resource writes its buffer, so no lock is taken.  Made before the resource
+  processes are started, so they inherit it.
+  '''
+  #----------------------------------------------------------------------------
+  def __init__(self, size):
+    '''
+    (int)size: The number of events kept.
+    '''
+    assert size > 0, 'size must be positive'
+    self.size = size
+    self.events = RawArray(_Event, size)
+    self.count = RawValue(ctypes.c_long, 0) #Events ever recorded
+    self.pid = RawValue(ctypes.c_long, 0) #The process of the resource
+    return
+
+  #----------------------------------------------------------------------------
+  def record(self, kind, seq, peer='', value=0.0, start=None):
+    '''
+    Records an event of kind (one of HANDLE, ...) for input vector seq.  If
+    start (a time.time()) is given the event lasts from then until now.
+    '''
+    now = time.time()
+    n = self.count.value
+    event = self.events[n % self.size]
+    if start == None:
+      event.ts = now
+      event.dur = 0.0
+    else:
+      event.ts = start
+      event.dur = now - start
+    event.kind = kind
+    event.seq = seq
+    event.peer = peer[:ID_SIZE]
+    event.value = value
+    self.count.value = n + 1
+    return
+
+  #----------------------------------------------------------------------------
+  def read(self):
+    '''
+    Returns the events kept, oldest first, as (ts, dur, kind, seq, peer,
+    value) tuples.
+    '''
+    n = self.count.value
+    first = max(0, n - self.size)
+    events = []
+    for k in range(first, n):
+      e = self.events[k % self.size]
+      events.append((e.ts, e.dur, e.kind, e.seq, e.peer, e.value))
+    return events
+
+  #----------------------------------------------------------------------------
+  def clear(self):
+    '''
+    Drops every event.
+    '''
+    self.count.value = 0
+    return
+
+#------------------------------------------------------------------------------
+def writeChromeTrace(resources, fileName):
+  '''
+  Merges the trace events of resources (those with a TraceBuffer) into a
+  Chrome trace JSON file, which chrome://tracing and Perfetto can open.
+  Every resource is a track, grouped by the process that ran it, and an
+  arrow joins each push to the handle of the same value by its receiver.
+  Returns the number of events written.
+  '''
+  traced = [R for R in resources if getattr(R, 'trace', None) != None]
+  read = dict((R.ID, R.trace.read()) for R in traced)
+  starts = [events[0][0] for events in read.values() if events]
+  t0 = min(starts) if starts else 0.0
+  tids = dict((R.ID, k + 1) for k, R in enumerate(traced))
+
+  out = []
+  pids = set()
+  for R in traced:
+    pid = R.trace.pid.value or os.getpid()
+    pids.add(pid)
+    out.append({'name': 'thread_name', 'ph': 'M', 'pid': pid,
+                'tid': tids[R.ID], 'args': {'name': R.ID}})
+
+    #The k'th push from a resource to another for an input vector is the
+    #k'th value the other handles from it for that vector, since each
+    #channel is first in, first out
+    occurrences = {}
+    for ts, dur, kind, seq, peer, value in read[R.ID]:
+      event = {'name': KINDS[kind], 'cat': R.__class__.__name__, 'pid': pid,
+               'tid': tids[R.ID], 'ts': (ts - t0)*1e6,
+               'args': {'seq': seq}}
+      if kind in (HANDLE, STALL):
+        event['ph'] = 'X'
+        event['dur'] = dur*1e6
+      else:
+        event['ph'] = 'i'
+        event['s'] = 't'
+      if peer:
+        event['args']['peer'] = peer
+      if kind in (CREDIT, FIRE):
+        event['args']['value'] = value
+      out.append(event)
+
+      if peer and kind in (PUSH, HANDLE):
+        if kind == PUSH:
+          key = (R.ID, peer, seq)
+        else:
+          key = (peer, R.ID, seq)
+        k = occurrences.get((kind, key), 0)
+        occurrences[(kind, key)] = k + 1
+        flow = {'name': 'value', 'cat': 'flow', 'pid': pid,
+                'tid': tids[R.ID], 'ts': (ts - t0)*1e6,
+                'id': '%s>%s#%d.%d' %(key + (k,))}
+        if kind == PUSH:
+          flow['ph'] = 's'
+        else:
+          flow['ph'] = 'f'
+          flow['bp'] = 'e'
+        out.append(flow)
+
+  for pid in pids:
+    out.append({'name': 'process_name', 'ph': 'M', 'pid': pid,
+                'args': {'name': 'Brain process %d' %pid}})
+  with open(fileName, 'w') as f:
+    json.dump({'traceEvents': out, 'displayTimeUnit': 'ms'}, f)
+  return len(out)
+
+#PRIVATE**********************************************************************
+#------------------------------------------------------------------------------
+class _Event(ctypes.Structure):
+  '''
+  One event in a TraceBuffer.
+  '''
+  _fields_ = [('ts', ctypes.c_double),
+              ('dur', ctypes.c_double),
+              ('value', ctypes.c_double),
+              ('seq', ctypes.c_long),
+              ('kind', ctypes.c_int),
+              ('peer', ctypes.c_char*ID_SIZE)]
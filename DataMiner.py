@@ -1,8 +1,16 @@
 #dataMiner.py
 import numpy as np
 import csv
+import hashlib
+import json
 import os
+import Queue
 import random
+import sys
+import threading
+
+#Version of the format written by DataMiner.saveData()
+MARSHALL_VERSION = 2
 
 #==============================================================================
 #------------------------------------------------------------------------------
@@ -21,7 +29,9 @@ class DataMiner(object):
 
 #PUBLIC***********************************************************************
   #----------------------------------------------------------------------------
-  def __init__(self, dataFile, marshallFile=None):
+  def __init__(self, dataFile, marshallFile=None, chunkSize=65536,
+               delimiter=',', featureDtype=np.float64, classDtype=np.float64,
+               categoricalColumns=None):
     '''
     Arguments----------------
     dataFile: The path to the file to read the raw data in from.  It will 
@@ -34,6 +44,23 @@ class DataMiner(object):
     marshalledFile: The path to the file with which to marshall data.  It will
     be created if it does not already exist.
 
+    chunkSize: The number of csv rows which are converted to a np.array at
+    once while mining.  Larger chunks are faster but use more memory.
+
+    delimiter: The character separating values in dataFile.
+
+    featureDtype: The np.dtype dataFeatures is stored in, eg. np.float32 or
+    np.float16 to save memory and disk.
+
+    classDtype: The np.dtype dataClasses is stored in, or 'compact' for the
+    smallest unsigned integer type which holds every class.
+
+    categoricalColumns: A list of the labels (or indices) of feature columns
+    holding names rather than numbers.  Each name is given an integer in
+    the order they are first seen, the same way as the class names.  By
+    default any feature column whose first value is not a number is
+    treated as categorical.
+
     Variables----------------
     dataFeatures: A np.array containing feature vectors.  
 
@@ -48,9 +75,39 @@ class DataMiner(object):
     classIntToName: A dictionary indexed by integers to output the class name
     represented by that number
 
+    categoryNameToInt: A dictionary indexed by the label of each categorical
+    column, holding a dictionary like classNameToInt for that column
+
+    categoryIntToName: The same as categoryNameToInt, but like
+    classIntToName
+
     dataFile: The file from which the original data was mined
 
     marshallFile: The file to which the data is marshalled.
+
+    chunkSize: The number of rows converted at once by mineData()
+
+    delimiter: The csv delimiter of dataFile
+
+    sourceFingerprint: The size, modification time and sha1 hash of dataFile
+    when it was mined.  It is saved with the data so mineData() can tell
+    whether the marshalled file is still up to date.
+
+    featureStats: A RunningStats with the mean and variance of every feature,
+    set by normalizeData() and saved with the data.  It is used to normalize
+    new data the same way, see mineChunks().
+
+    normalized: True once dataFeatures has been normalized.
+
+    fixedPoint: None, or a dict {'wordWidth': w, 'fracBits': f} once
+    quantizeData() has turned dataFeatures into fixed point integers.
+
+    permutation: The shuffled order of the rows as a np.array of row
+    indices, or None if the rows are in the order they were mined.  See
+    shuffleData().
+
+    splits: A dict from split name ('train', 'test' and 'validation' by
+    default) to the rows in that split, built by defineSplits().
     '''
     
     #VARIABLES
@@ -59,8 +116,20 @@ class DataMiner(object):
     self.dataLabels = []
     self.classNameToInt = {}
     self.classIntToName = {}
+    self.categoryNameToInt = {}
+    self.categoryIntToName = {}
     self.dataFile = ''
     self.marshallFile = ''
+    self.chunkSize = 0
+    self.delimiter = ','
+    self.sourceFingerprint = None
+    self.featureStats = None
+    self.normalized = False
+    self.fixedPoint = None
+    self.permutation = None
+    self.splits = None
+    self.splitOptions = ((0.7, 0.2, 0.1), ('train', 'test', 'validation'),
+                         False)
 
     #Input Variables -----------------------        
     #Sanity Checks
@@ -93,26 +162,48 @@ class DataMiner(object):
         raise AssertionError('You need write access to: ' +  marshallFile)
     #}
 
+    if (chunkSize < 1):
+      raise AssertionError('chunkSize must be at least 1')
+
     #{ Assigns arguments to class variables
     self.dataFile = dataFile
     self.marshallFile = marshallFile
+    self.chunkSize = int(chunkSize)
+    self.delimiter = delimiter
+    self.featureDtype = np.dtype(featureDtype)
+    self.categoricalColumns = categoricalColumns
+    self.classDtype = 'compact'
+    if not (isinstance(classDtype, str) and classDtype == 'compact'):
+      self.classDtype = np.dtype(classDtype)
     #}
 
     return
 
   #--------------------------------------------------------------------------
-  def shuffleData(self):
+  def shuffleData(self, seed=None, materialize=False):
     '''
     This function simply randomizes the order of all the data vectors.
+
+    The new order is kept as an index in permutation rather than moving the
+    data, so dataFeatures and dataClasses are left as they were mined and
+    the getters read their rows through the permutation.  Shuffling again
+    replaces the permutation rather than stacking on it.
+
+    seed: Seeds the random order so it can be reproduced.  None gives a
+    different order every time.
+
+    materialize: If True the rows of dataFeatures and dataClasses are
+    actually reordered (one copy of each) and permutation is reset to None.
     '''
     print 'Randomizing data ... ',
-    temp = np.array([])
-    temp = np.hstack((self.dataFeatures, self.dataClasses))
-    np.random.shuffle(temp)
-    self.dataFeatures, self.dataClasses = np.hsplit(temp, 
-                                                    [np.shape(temp)[1]-1])
+    self.splits = None
+    self.permutation = np.random.RandomState(seed).permutation(
+      len(self.dataFeatures))
+    if materialize:
+      self.dataFeatures = self.dataFeatures[self.permutation]
+      self.dataClasses = self.dataClasses[self.permutation]
+      self.permutation = None
     print 'Done'
-#    print self.dataFeatures
     return
 
   #--------------------------------------------------------------------------
@@ -131,48 +222,208 @@ class DataMiner(object):
 
     classIntToName: A dictionary containing integer representation of
     classes and their names
+
+    If the data has been shuffled the features and classes are returned in
+    the shuffled order, which copies them.
     '''
-    return (self.dataFeatures, self.dataClasses,
+    dataFeatures, dataClasses = self._take(slice(None))
+    return (dataFeatures, dataClasses,
             self.classNameToInt, self.classIntToName,
             self.dataLabels)
 
+  #--------------------------------------------------------------------------
+  def defineSplits(self, ratios=(0.7, 0.2, 0.1),
+                   names=('train', 'test', 'validation'), stratify=False):
+    '''
+    Divides the (shuffled) rows into named splits, which are returned by
+    getSplit() and by getTrainData(), getTestData() and getValidationData()
+    for the default names.  The splits are worked out once, as slices or
+    index arrays, and kept in splits until the data is mined, loaded or
+    shuffled again, when they are rebuilt with the same arguments.
+
+    ratios: The relative size of each split.  Every split but the last gets
+    ceil(ratio*len) rows, and the last gets the rest.
+
+    names: The name of each split.
+
+    stratify: If True each class is divided by the ratios separately, so
+    every split has the same class proportions as the whole data set.
+    '''
+    if len(ratios) != len(names):
+      raise AssertionError('There must be a name for every ratio')
+    self.splitOptions = (tuple(ratios), tuple(names), stratify)
+
+    if not stratify:
+      bounds = self._splitBounds(len(self.dataFeatures), ratios)
+      self.splits = dict((names[j], slice(bounds[j], bounds[j + 1]))
+                         for j in range(len(names)))
+      return
+
+    parts = [[] for name in names]
+    for positions in self._classPositions():
+      bounds = self._splitBounds(len(positions), ratios)
+      for j in range(len(names)):
+        parts[j].append(positions[bounds[j]:bounds[j + 1]])
+    self.splits = dict((names[j], np.sort(np.concatenate(parts[j])))
+                       for j in range(len(names)))
+    return
+
+  #--------------------------------------------------------------------------
+  def getSplit(self, name):
+    '''
+    Returns a tuple (dataFeatures, dataClasses) with the rows of the split
+    called name, see defineSplits().  Contiguous splits of unshuffled data
+    are views, anything else gathers just the rows of the split.
+    '''
+    if self.splits == None:
+      self.defineSplits(*self.splitOptions)
+    if not name in self.splits:
+      raise KeyError('There is no split called ' + str(name))
+    return self._take(self.splits[name])
+
   #--------------------------------------------------------------------------  
   def getTrainData(self):
     '''
     Returns 70% of the data to form a training set.
     Returns a tuple containing ((70%) dataFeatures, (70%) dataClasses)
+    The amount can be changed with defineSplits().
     '''
-    
-    dataLen = len(self.dataFeatures)
-    returnAmount = np.ceil(dataLen*0.7)
-    return self.dataFeatures[0:returnAmount], self.dataClasses[0:returnAmount]    
+    return self.getSplit('train')
 
   #--------------------------------------------------------------------------
   def getTestData(self):
     '''
     Returns 20% of the data for a test set.
     Returns a tuple containing ((20%) dataFeatures, (20%) dataClasses)
+    The amount can be changed with defineSplits().
     '''
-    
-    dataLen = len(self.dataFeatures)
-    returnAmount = np.ceil(dataLen*0.2)
-    trainAmount = np.ceil(dataLen*0.7)
-    return (self.dataFeatures[trainAmount:trainAmount + returnAmount],
-            self.dataClasses[trainAmount:trainAmount + returnAmount])
+    return self.getSplit('test')
 
   #--------------------------------------------------------------------------
   def getValidationData(self):
     '''
     Returns 10% of the data for a validation set.
     Returns a tuple containing ((10%) dataFeatures, (10%) dataClasses)
+    The amount can be changed with defineSplits().
     '''
-    
-    dataLen = len(self.dataFeatures)
-    usedAmount = np.ceil(dataLen*0.7) + np.ceil(dataLen*0.2)
-    return (self.dataFeatures[usedAmount:], self.dataClasses[usedAmount:])
+    return self.getSplit('validation')
+
+  #--------------------------------------------------------------------------
+  def kFolds(self, k, stratify=False):
+    '''
+    A generator for k-fold cross validation.  The (shuffled) rows are dealt
+    into k folds and for each fold it yields a tuple
+    ((trainFeatures, trainClasses), (testFeatures, testClasses)) where the
+    fold is the test set and the other k - 1 folds are the training set.
+    Only the index arrays are built up front; the rows of each fold are
+    gathered when it is reached.
+
+    stratify: If True the rows of every class are dealt round the folds in
+    turn, so each fold has the same class proportions.
+    '''
+    if (k < 2 or k > len(self.dataFeatures)):
+      raise AssertionError('k must be between 2 and the number of rows')
+
+    fold = np.empty(len(self.dataFeatures), dtype = np.intp)
+    if not stratify:
+      fold[:] = np.arange(len(fold))*k//len(fold)
+    else:
+      for positions in self._classPositions():
+        fold[positions] = np.arange(len(positions)) % k
+
+    for j in range(k):
+      yield (self._take(np.flatnonzero(fold != j)),
+             self._take(np.flatnonzero(fold == j)))
+    return
+
+  #--------------------------------------------------------------------------
+  def batches(self, batchSize, split=None, inputSizes=None, prefetch=2):
+    '''
+    A generator of mini-batches ready for Brain.activate().  Each item is a
+    tuple (X, classes) where X is a list of batchSize input vectors and
+    classes is the matching (batchSize, 1) slice of dataClasses.  Every
+    input vector is a list with a tuple of features for each InputNode, eg:
+
+      for X, classes in miner.batches(32, 'train', inputSizes=(2, 2)):
+        for x in X:
+          y = brain.activate(x)   #x == [(f0, f1), (f2, f3)]
+
+    The batches are built by a background thread which keeps up to
+    prefetch of them ready while the caller is busy with the network.
+
+    split: The name of a split (see defineSplits()), or None for all rows.
+    Rows are read in shuffled order through the permutation.
+
+    inputSizes: The number of features taken by each InputNode, in order.
+    By default all the features go to a single InputNode.
+    '''
+    numFeatures = np.shape(self.dataFeatures)[1]
+    if inputSizes == None:
+      inputSizes = (numFeatures,)
+    if sum(inputSizes) != numFeatures:
+      raise AssertionError('inputSizes must add up to the ' +
+                           str(numFeatures) + ' features')
+    if (batchSize < 1 or prefetch < 1):
+      raise AssertionError('batchSize and prefetch must be at least 1')
+
+    if split == None:
+      rows = slice(0, len(self.dataFeatures))
+    else:
+      if self.splits == None:
+        self.defineSplits(*self.splitOptions)
+      rows = self.splits[split]
+    if isinstance(rows, slice):
+      start, stop, step = rows.indices(len(self.dataFeatures))
+      pieces = [slice(j, min(j + batchSize, stop))
+                for j in range(start, stop, batchSize)]
+    else:
+      pieces = [rows[j:j + batchSize] for j in range(0, len(rows), batchSize)]
+
+    bounds = np.cumsum((0,) + tuple(inputSizes))
+    bounds = zip(bounds[:-1], bounds[1:])
+    batchQueue = Queue.Queue(prefetch)
+    stopEvent = threading.Event()
+
+    def offer(item):
+      #Gives up if the consumer has gone away, so the thread can finish
+      while not stopEvent.is_set():
+        try:
+          batchQueue.put(item, timeout = 0.1)
+          return True
+        except Queue.Full:
+          pass
+      return False
+
+    def produce():
+      try:
+        for piece in pieces:
+          features, classes = self._take(piece)
+          X = [[tuple(row[a:b]) for a, b in bounds]
+               for row in features.tolist()]
+          if not offer(('batch', (X, classes))):
+            return
+        offer(('done', None))
+      except Exception:
+        offer(('error', sys.exc_info()))
+      return
+
+    producer = threading.Thread(target = produce)
+    producer.daemon = True
+    producer.start()
+    try:
+      while True:
+        kind, item = batchQueue.get()
+        if kind == 'done':
+          break
+        elif kind == 'error':
+          raise item[0], item[1], item[2]
+        yield item
+    finally:
+      stopEvent.set()
+    return
 
   #--------------------------------------------------------------------------
-  def mineData(self):
+  def mineData(self, useCache=True):
     '''
     Gathers data from the file given at initialization.  It is assumed to 
     be a comma seperated value file.  It also asks that the top row be 
@@ -181,49 +432,206 @@ class DataMiner(object):
     to each of the classes to which the data belongs.  In the future,
     support for un-labled data may be added, but I have no reason to do 
     so now.  Read access is necessary.
+
+    Rows are parsed chunkSize at a time by mineChunks() and copied into
+    arrays which double in size when they fill up.
+
+    If useCache is True and the marshalled file was saved from this exact
+    dataFile with the same parse options (see cacheIsFresh()), it is loaded
+    with loadData() instead of parsing the csv again.  Note that it then
+    holds whatever was saved, eg. normalized and shuffled data.
     '''
+    if useCache and self.cacheIsFresh():
+      self.loadData()
+      return
     
+    fingerprint = self._fingerprint()
     print 'Gathering data from ', self.dataFile, ' ... ',
-    numClasses = 0
+    numRows = 0
+    self.dataFeatures = np.empty(shape = [0, 0], dtype = self.featureDtype)
+    self.dataClasses = np.empty(shape = [0, 1], dtype = self._classBuffer())
+    for features, classes in self.mineChunks():
+      end = numRows + len(features)
+      if end > len(self.dataFeatures):
+        self._growData(max(end, 2*len(self.dataFeatures), self.chunkSize),
+                       numRows, features.shape[1])
+      self.dataFeatures[numRows:end] = features
+      self.dataClasses[numRows:end] = classes
+      numRows = end
+
+    if numRows == 0:
+      self.dataFeatures = np.empty(shape = [0, len(self.dataLabels) - 1],
+                                   dtype = self.featureDtype)
+    elif len(self.dataFeatures) != numRows:
+      self.dataFeatures = self.dataFeatures[:numRows].copy()
+      self.dataClasses = self.dataClasses[:numRows].copy()
+    if self.dataClasses.dtype != self._classType():
+      self.dataClasses = self.dataClasses.astype(self._classType())
+    self.sourceFingerprint = fingerprint
+    self.featureStats = None
+    self.normalized = False
+    self.fixedPoint = None
+    self.permutation = None
+    self.splits = None
+    print 'Done'
+    return
+
+  #--------------------------------------------------------------------------
+  def cacheIsFresh(self):
+    '''
+    Returns True if the marshalled file exists and was saved from the
+    current contents of dataFile using the current parse options.  A file
+    whose size differs is stale.  If the size and modification time both
+    match the file is assumed unchanged, otherwise the sha1 hash of dataFile
+    is compared, so a file that was only touched still counts as fresh.
+    '''
+    fileName = self._marshallFileName()
+    try:
+      with open(fileName, 'r') as f:
+        metadata = json.load(f)
+    except (IOError, ValueError):
+      return False
+
+    saved = metadata.get('sourceFingerprint')
+    if (saved == None or metadata.get('version') != MARSHALL_VERSION or
+        metadata.get('parseOptions') != self._parseOptions()):
+      return False
+
+    status = os.stat(self.dataFile)
+    if status.st_size != saved['size']:
+      return False
+    if status.st_mtime != saved['mtime']:
+      fingerprint = self._fingerprint()
+      if fingerprint['sha1'] != saved['sha1']:
+        return False
+    return True
+
+  #--------------------------------------------------------------------------
+  def mineChunks(self, chunkSize=None, normalize=False, quantize=False):
+    '''
+    A generator which reads the data file chunkSize rows at a time (the
+    chunkSize given at initialization by default) and yields a tuple of
+    np.arrays (features, classes) for each chunk.  classes has shape (n, 1)
+    like dataClasses.  Class names are given integers in the order they are
+    first seen, so classNameToInt and classIntToName stay consistent from
+    one chunk to the next.  dataLabels is set once the header has been read.
+
+    dataFeatures and dataClasses are left alone, so a file larger than
+    memory can be streamed straight into a network, eg:
+
+      for features, classes in miner.mineChunks():
+        for row in features:
+          y = brain.activate([tuple(row)])
+
+    If normalize is True every chunk is normalized with featureStats as it
+    is read.  The stats of a file too large for normalizeData() can be built
+    with an extra pass first:
+
+      miner.featureStats = RunningStats()
+      for features, classes in miner.mineChunks():
+        miner.featureStats.update(features)
+
+    If quantize is True the (normalized) features are also converted to the
+    fixed point format in fixedPoint, see quantizeData().  With
+    classDtype='compact' the dtype of classes can widen as classes are
+    found.
+    '''
+    if chunkSize == None:
+      chunkSize = self.chunkSize
+    if (chunkSize < 1):
+      raise AssertionError('chunkSize must be at least 1')
+    if normalize and self.featureStats == None:
+      raise AssertionError('There are no featureStats to normalize with')
+    if quantize and self.fixedPoint == None:
+      raise AssertionError('There is no fixedPoint format to quantize to')
+
+    self.classNameToInt = {}
+    self.classIntToName = {}
+    self.categoryNameToInt = {}
+    self.categoryIntToName = {}
     with open(self.dataFile, 'rb') as csvFile:
-      csvReader = csv.reader(csvFile, delimiter=',')
+      csvReader = csv.reader(csvFile, delimiter=self.delimiter)
       self.dataLabels = csvReader.next()
       try:
         classIndex = self.dataLabels.index('class')
       except ValueError:
         classIndex = len(self.dataLabels) - 1
-    
-      self.dataFeatures = np.zeros(shape = [1,len(self.dataLabels) - 1])
-      self.dataClasses = np.zeros(shape = [1,1])
+      featureIndex = [j for j in range(len(self.dataLabels))
+                      if j != classIndex]
+
+      categoricalIndex = None
+      chunk = []
       for line in csvReader:
         if (line == []): continue #Incase there is a blank line...
-        if (not line[classIndex] in self.classNameToInt.keys()):
-          self.classNameToInt[line[classIndex]] = numClasses
-          self.classIntToName[numClasses] = line[classIndex]
-          numClasses += 1
-
-        feature = map(float, [fl for fl in line
-                              if line.index(fl) != classIndex])
-        self.dataFeatures = np.vstack([self.dataFeatures, feature])
-        self.dataClasses = np.vstack([self.dataClasses, 
-                                     self.classNameToInt[line[classIndex]]])
-
-      self.dataFeatures = self.dataFeatures[1:]
-      self.dataClasses = self.dataClasses[1:]
-      print 'Done'
-      return
+        if categoricalIndex == None:
+          categoricalIndex = self._categoricalIndex(line, featureIndex)
+        chunk.append(line)
+        if len(chunk) == chunkSize:
+          yield self._convertChunk(chunk, classIndex, featureIndex,
+                                   categoricalIndex, normalize, quantize)
+          chunk = []
+      if chunk:
+        yield self._convertChunk(chunk, classIndex, featureIndex,
+                                 categoricalIndex, normalize, quantize)
+    return
 
   #-------------------------------------------------------------------------
   def normalizeData(self):
     '''
     Normalizes the data by subtracting the mean value from each feature
-    and then dividing by the standard deviation.
+    and then dividing by the standard deviation.  The mean and variance are
+    accumulated into featureStats a chunk at a time, and the data is then
+    normalized in place, so no full sized temporaries are made.  Does
+    nothing if the data is already normalized, eg. when it came from the
+    cache.
     '''
+    if self.normalized:
+      return
+    if self.fixedPoint != None:
+      raise AssertionError('Quantized data can not be normalized')
     print 'Normalizing data ... ',
-    mean = np.mean(self.dataFeatures, axis = 0)
-    SD = np.std(self.dataFeatures, axis = 0)
-    self.dataFeatures = np.subtract(self.dataFeatures, mean)
-    self.dataFeatures = np.divide(self.dataFeatures, SD)
+    self.featureStats = RunningStats()
+    for start in range(0, len(self.dataFeatures), self.chunkSize):
+      self.featureStats.update(
+        self.dataFeatures[start:start + self.chunkSize])
+
+    if not self.dataFeatures.flags.writeable:
+      self.dataFeatures = np.array(self.dataFeatures)
+    for start in range(0, len(self.dataFeatures), self.chunkSize):
+      block = self.dataFeatures[start:start + self.chunkSize]
+      self.featureStats.normalize(block, out = block)
+    self.normalized = True
+    print 'Done'
+    return
+
+  #-------------------------------------------------------------------------
+  def quantizeData(self, wordWidth=16, fracBits=None):
+    '''
+    Converts dataFeatures to signed fixed point numbers, which is what the
+    FPGA works with.  Each value becomes round(x * 2**fracBits), saturated
+    to wordWidth bits (including the sign) and stored in the smallest
+    integer type that holds them, eg. np.int16 for the default.  It should
+    be called after normalizeData().  The format is kept in fixedPoint and
+    saved with the data, and fromFixedPoint() converts back.
+
+    fracBits: The number of fractional bits.  By default it is chosen from
+    the largest magnitude in the data so that nothing saturates.
+    '''
+    if self.fixedPoint != None:
+      raise AssertionError('The data is already quantized')
+    if fracBits == None:
+      fracBits = fracBitsFor(np.max(np.abs(self.dataFeatures))
+                             if np.size(self.dataFeatures) else 0, wordWidth)
+
+    print 'Quantizing data ... ',
+    quantized = np.empty(np.shape(self.dataFeatures),
+                         dtype = fixedPointType(wordWidth))
+    for start in range(0, len(self.dataFeatures), self.chunkSize):
+      toFixedPoint(self.dataFeatures[start:start + self.chunkSize],
+                   wordWidth, fracBits,
+                   out = quantized[start:start + self.chunkSize])
+    self.dataFeatures = quantized
+    self.fixedPoint = {'wordWidth': wordWidth, 'fracBits': fracBits}
     print 'Done'
     return
 
@@ -235,41 +643,68 @@ class DataMiner(object):
     is one) of the input file, and add the '.marshalled' extension.  It 
     will also hide the .marshalled file by appending a '.'.  Write access
     is necessary.
+
+    The .marshalled file itself is a small json file holding dataLabels and
+    the class and category names.  dataFeatures and dataClasses are written
+    as raw .npy files beside it (<marshalled>.features.npy and
+    <marshalled>.classes.npy, plus <marshalled>.permutation.npy if the data
+    is shuffled) so that loadData() can memory map them.  Every file is written under a
+    temporary name and renamed into place, so arrays that are currently
+    memory mapped from an earlier save are never truncated underneath us.
     '''
-    if self.marshallFile == None:
-      fileName = self.dataFile.split('.')[0]
-      fileName = '.' + fileName + '.marshalled'
-    else:
-      fileName = self.marshallFile
+    fileName = self._marshallFileName()
     
     if(not os.access(os.path.dirname('./' + fileName), os.W_OK)):
       raise AssertionError('You must have write access to this file: ' + 
                            fileName)
 
     print 'Saving data to ', fileName, ' ... ',
-    f = open(fileName, 'w')
-    data = (self.dataLabels, self.classNameToInt, self.classIntToName,
-            self.dataClasses, self.dataFeatures)
-    np.save(f, data)
-    f.close()
+    self._replaceFile(fileName + '.features.npy',
+                      lambda f: np.save(f, self.dataFeatures))
+    self._replaceFile(fileName + '.classes.npy',
+                      lambda f: np.save(f, self.dataClasses))
+    if self.permutation is not None:
+      self._replaceFile(fileName + '.permutation.npy',
+                        lambda f: np.save(f, self.permutation))
+
+    #The metadata is written last so a partly written save is never loaded
+    metadata = {'version': MARSHALL_VERSION,
+                'dataLabels': self.dataLabels,
+                'classNames': [self.classIntToName[j]
+                               for j in range(len(self.classIntToName))],
+                'categories': dict((label, [names[j]
+                                            for j in range(len(names))])
+                                   for label, names
+                                   in self.categoryIntToName.items()),
+                'sourceFingerprint': self.sourceFingerprint,
+                'parseOptions': self._parseOptions(),
+                'normalized': self.normalized,
+                'shuffled': self.permutation is not None,
+                'fixedPoint': self.fixedPoint,
+                'featureStats': None,
+               }
+    if self.featureStats != None:
+      metadata['featureStats'] = self.featureStats.toDict()
+    self._replaceFile(fileName, lambda f: json.dump(metadata, f))
     print 'Done'
     return
 
       
   #-------------------------------------------------------------------------
-  #NOTE np.load() supports memory mapped files
-  def loadData(self): 
+  def loadData(self, mmapMode='r'): 
     '''
     Loads data in from a marshalled file.  If a file name isn't
     specified at initialization it will remove the file extension (if there
     is one) and add a '.marshalled' extension, and append a '.'.  Read
     access is necessary.
+
+    mmapMode: Passed to np.load() for dataFeatures and dataClasses.  The
+    default 'r' maps the arrays read only, so loading is almost free and the
+    pages are shared between every process reading the same file.  Use 'c'
+    for a writable copy-on-write map, or None to read them into memory.
+    Files saved in the old single pickled .npy format are still read.
     '''
-    if self.marshallFile == None:
-      fileName = self.dataFile.split('.')[0]
-      fileName = '.' + fileName + '.marshalled'
-    else:
-      fileName = self.marshallFile
+    fileName = self._marshallFileName()
     
     if(not os.path.isfile('./' + fileName)):
       raise AssertionError('File does not exist for loading: ' + fileName)
@@ -281,21 +716,461 @@ class DataMiner(object):
 
     print 'Loading data from ', fileName, ' ... ',
 
-    f = open(fileName, 'r')
-    #Throws a cPickle error if the file is corrupt
-    (self.dataLabels, self.classNameToInt, self.classIntToName,
-     self.dataClasses, self.dataFeatures) = np.load(f)
-    f.close()
+    with open(fileName, 'rb') as f:
+      legacy = (f.read(6) == '\x93NUMPY')
+    if legacy:
+      #Throws a cPickle error if the file is corrupt
+      (self.dataLabels, self.classNameToInt, self.classIntToName,
+       self.dataClasses, self.dataFeatures) = np.load(fileName,
+                                                      allow_pickle=True)
+      self.sourceFingerprint = None
+      self.featureStats = None
+      self.normalized = False
+      self.fixedPoint = None
+      self.permutation = None
+      self.splits = None
+      print 'Done'
+      return
+
+    with open(fileName, 'r') as f:
+      metadata = json.load(f)
+    if metadata['version'] > MARSHALL_VERSION:
+      raise AssertionError(fileName + ' was saved by a newer DataMiner')
+
+    self.dataLabels = [_toStr(label) for label in metadata['dataLabels']]
+    self.classIntToName = dict(enumerate(_toStr(name)
+                                         for name in metadata['classNames']))
+    self.classNameToInt = dict((name, j) for j, name
+                               in self.classIntToName.items())
+    self.categoryNameToInt = {}
+    self.categoryIntToName = {}
+    for label, names in metadata.get('categories', {}).items():
+      intToName = dict(enumerate(_toStr(name) for name in names))
+      self.categoryIntToName[_toStr(label)] = intToName
+      self.categoryNameToInt[_toStr(label)] = dict(
+        (name, j) for j, name in intToName.items())
+    self.sourceFingerprint = metadata.get('sourceFingerprint')
+    self.normalized = metadata.get('normalized', False)
+    self.fixedPoint = None
+    if metadata.get('fixedPoint') != None:
+      self.fixedPoint = dict((str(key), value) for key, value
+                             in metadata['fixedPoint'].items())
+    self.featureStats = None
+    if metadata.get('featureStats') != None:
+      self.featureStats = RunningStats.fromDict(metadata['featureStats'])
+    self.dataFeatures = np.load(fileName + '.features.npy', mmap_mode=mmapMode)
+    self.dataClasses = np.load(fileName + '.classes.npy', mmap_mode=mmapMode)
+    self.permutation = None
+    self.splits = None
+    if metadata.get('shuffled'):
+      self.permutation = np.load(fileName + '.permutation.npy',
+                                 mmap_mode=mmapMode)
     print 'Done'
     return
 
 #PRIVATE**********************************************************************
+  #-------------------------------------------------------------------------
+  def _take(self, rows):
+    '''
+    Returns (features, classes) for rows, a slice or an index array of
+    positions in the shuffled order.  Without a permutation a slice gives
+    views of dataFeatures and dataClasses, otherwise only the requested rows
+    are gathered.
+    '''
+    if self.permutation is None:
+      if isinstance(rows, slice):
+        return self.dataFeatures[rows], self.dataClasses[rows]
+      index = rows
+    else:
+      index = self.permutation[rows]
+    return (np.take(self.dataFeatures, index, axis = 0),
+            np.take(self.dataClasses, index, axis = 0))
+
+  #-------------------------------------------------------------------------
+  def _classPositions(self):
+    '''
+    Returns a list with an array for every class of the positions, in
+    shuffled order, of the rows of that class.
+    '''
+    if self.permutation is None:
+      labels = np.ravel(self.dataClasses)
+    else:
+      labels = np.take(np.ravel(self.dataClasses), self.permutation)
+    return [np.flatnonzero(labels == label) for label in np.unique(labels)]
+
+  #-------------------------------------------------------------------------
+  def _splitBounds(self, numRows, ratios):
+    '''
+    Returns the boundaries of splits of numRows rows with the given ratios.
+    Every split but the last gets ceil(ratio*numRows) rows.  The tolerance
+    stops rounding error (eg. sum((0.7, 0.2, 0.1)) < 1) adding a row.
+    '''
+    total = float(sum(ratios))
+    bounds = [0]
+    for ratio in ratios[:-1]:
+      size = int(np.ceil(numRows*ratio/total - 1e-9))
+      bounds.append(min(numRows, bounds[-1] + size))
+    bounds.append(numRows)
+    return bounds
+
+  #-------------------------------------------------------------------------
+  def _marshallFileName(self):
+    '''
+    Returns the name of the marshalled file, see saveData().
+    '''
+    if self.marshallFile == None:
+      fileName = self.dataFile.split('.')[0]
+      return '.' + fileName + '.marshalled'
+    return self.marshallFile
+
+  #-------------------------------------------------------------------------
+  def _parseOptions(self):
+    '''
+    Returns a dict of every option that changes what mineData() produces.
+    A marshalled file saved with different options is not used as a cache.
+    '''
+    return {'delimiter': self.delimiter,
+            'featureDtype': self.featureDtype.str,
+            'classDtype': (self.classDtype if self._compactClasses()
+                           else self.classDtype.str),
+            'categoricalColumns': self.categoricalColumns,
+           }
+
+  #-------------------------------------------------------------------------
+  def _classType(self):
+    '''
+    Returns the dtype for dataClasses given the classes seen so far.
+    '''
+    if self._compactClasses():
+      return np.min_scalar_type(max(len(self.classNameToInt) - 1, 0))
+    return self.classDtype
+
+  #-------------------------------------------------------------------------
+  def _classBuffer(self):
+    '''
+    Returns the dtype classes are gathered in by mineData() before the
+    number of classes is known.
+    '''
+    if self._compactClasses():
+      return np.dtype(np.uint32)
+    return self.classDtype
+
+  #-------------------------------------------------------------------------
+  def _compactClasses(self):
+    '''
+    Returns True if classDtype is 'compact'.
+    '''
+    return isinstance(self.classDtype, str)
+
+  #-------------------------------------------------------------------------
+  def _fingerprint(self):
+    '''
+    Returns a dict with the size, modification time and sha1 hash of
+    dataFile.
+    '''
+    status = os.stat(self.dataFile)
+    digest = hashlib.sha1()
+    with open(self.dataFile, 'rb') as f:
+      block = f.read(1 << 20)
+      while block:
+        digest.update(block)
+        block = f.read(1 << 20)
+    return {'size': status.st_size, 'mtime': status.st_mtime,
+            'sha1': digest.hexdigest()}
+
+  #-------------------------------------------------------------------------
+  def _replaceFile(self, fileName, write):
+    '''
+    Calls write() with a file opened on a temporary name next to fileName,
+    then renames it over fileName.
+    '''
+    tempName = fileName + '.tmp'
+    with open(tempName, 'wb') as f:
+      write(f)
+    os.rename(tempName, fileName)
+    return
+
+  #-------------------------------------------------------------------------
+  def _convertChunk(self, chunk, classIndex, featureIndex, categoricalIndex,
+                    normalize=False, quantize=False):
+    '''
+    Converts a list of csv rows into a tuple of np.arrays (features, classes).
+    The class column and the categorical columns (categoricalIndex) are
+    encoded with _intern().  The features are normalized with featureStats
+    if normalize is True, and then converted to fixedPoint if quantize is
+    True.
+    '''
+    block = np.array(chunk)
+    if (block.ndim != 2 or block.shape[1] != len(self.dataLabels)):
+      raise ValueError('Every row of ' + self.dataFile + ' must have ' +
+                       str(len(self.dataLabels)) + ' columns')
+
+    classes = np.empty(shape = [len(chunk), 1], dtype = self._classBuffer())
+    classes[:, 0] = self._intern(block[:, classIndex], self.classNameToInt,
+                                 self.classIntToName)
+
+    if not categoricalIndex:
+      features = block[:, featureIndex].astype(self.featureDtype)
+    else:
+      features = np.empty(shape = [len(chunk), len(featureIndex)],
+                          dtype = self.featureDtype)
+      for j in range(len(featureIndex)):
+        column = block[:, featureIndex[j]]
+        if not featureIndex[j] in categoricalIndex:
+          features[:, j] = column.astype(self.featureDtype)
+          continue
+        label = self.dataLabels[featureIndex[j]]
+        features[:, j] = self._intern(column,
+                                      self.categoryNameToInt[label],
+                                      self.categoryIntToName[label])
+    if normalize:
+      self.featureStats.normalize(features, out = features)
+    if quantize:
+      features = toFixedPoint(features, **self.fixedPoint)
+    return features, classes.astype(self._classType(), copy = False)
+
+  #-------------------------------------------------------------------------
+  def _categoricalIndex(self, line, featureIndex):
+    '''
+    Returns the set of indices of the categorical columns, given the first
+    data row, and sets up their entries in categoryNameToInt and
+    categoryIntToName.
+    '''
+    if self.categoricalColumns == None:
+      categorical = set(j for j in featureIndex if not _isNumber(line[j]))
+    else:
+      categorical = set()
+      for column in self.categoricalColumns:
+        if not isinstance(column, int):
+          column = self.dataLabels.index(column)
+        if not column in featureIndex:
+          raise AssertionError(str(column) + ' is not a feature column')
+        categorical.add(column)
+
+    for j in categorical:
+      self.categoryNameToInt[self.dataLabels[j]] = {}
+      self.categoryIntToName[self.dataLabels[j]] = {}
+    return categorical
+
+  #-------------------------------------------------------------------------
+  def _intern(self, column, nameToInt, intToName):
+    '''
+    Returns a np.array with the integer for every name in the np.array
+    column, adding any new names to the dictionaries nameToInt and
+    intToName.  New names get the next free integers in the order they first
+    appear.  Only the distinct names of the column are looked up, the rows
+    themselves are mapped with np.unique's inverse index.
+    '''
+    names, first, inverse = np.unique(column, return_index = True,
+                                      return_inverse = True)
+    codes = np.empty(len(names), dtype = np.intp)
+    for j in np.argsort(first):
+      name = str(names[j])
+      if (not name in nameToInt):
+        intToName[len(nameToInt)] = name
+        nameToInt[name] = len(nameToInt)
+      codes[j] = nameToInt[name]
+    return codes[inverse]
+
+  #-------------------------------------------------------------------------
+  def _growData(self, capacity, numRows, numFeatures):
+    '''
+    Reallocates dataFeatures and dataClasses to hold capacity rows, keeping
+    the first numRows rows.
+    '''
+    features = np.empty(shape = [capacity, numFeatures],
+                        dtype = self.featureDtype)
+    classes = np.empty(shape = [capacity, 1], dtype = self._classBuffer())
+    if numRows > 0:
+      features[:numRows] = self.dataFeatures[:numRows]
+      classes[:numRows] = self.dataClasses[:numRows]
+    self.dataFeatures, self.dataClasses = features, classes
+    return
+
+#==============================================================================
+#------------------------------------------------------------------------------
+class RunningStats(object):
+  '''
+  Description--------------
+  Keeps the count, mean and sum of squared deviations (M2) of every feature,
+  so the mean and standard deviation of a data set can be built up a chunk
+  at a time with update(), using Welford's method as extended by Chan et al.
+  to whole chunks.  Stats gathered separately, eg. by different workers,
+  are combined with merge().  The variance is the population variance, the
+  same as np.std().
+
+  Functions----------------
+  update(X): Adds the rows of X
+  merge(other): Adds the rows counted by another RunningStats
+  variance(), std(): The current estimates
+  normalize(X, out): Returns (X - mean) / std
+  toDict(), fromDict(d): For saving with the marshalled data
+  '''
+
+  #----------------------------------------------------------------------------
+  def __init__(self):
+    '''
+    Variables----------------
+    count: The number of rows seen
+
+    mean: A np.array with the mean of every feature
+
+    M2: A np.array with the sum of squared deviations from the mean
+    '''
+    self.count = 0
+    self.mean = np.array([])
+    self.M2 = np.array([])
+    return
+
+  #----------------------------------------------------------------------------
+  def update(self, X):
+    '''
+    Adds the rows of the 2d array X.
+    '''
+    if len(X) == 0:
+      return
+    chunk = RunningStats()
+    chunk.count = len(X)
+    chunk.mean = np.mean(X, axis = 0, dtype = np.float64)
+    deviation = np.subtract(X, chunk.mean)
+    chunk.M2 = np.einsum('ij,ij->j', deviation, deviation)
+    self.merge(chunk)
+    return
+
+  #----------------------------------------------------------------------------
+  def merge(self, other):
+    '''
+    Adds the rows counted by the RunningStats other.
+    '''
+    if other.count == 0:
+      return
+    if self.count == 0:
+      self.count = other.count
+      self.mean = other.mean.copy()
+      self.M2 = other.M2.copy()
+      return
+    count = self.count + other.count
+    delta = other.mean - self.mean
+    self.mean = self.mean + delta*(float(other.count)/count)
+    self.M2 = (self.M2 + other.M2 +
+               delta*delta*(float(self.count)*other.count/count))
+    self.count = count
+    return
+
+  #----------------------------------------------------------------------------
+  def variance(self):
+    '''
+    Returns the population variance of every feature.
+    '''
+    return self.M2/self.count
+
+  #----------------------------------------------------------------------------
+  def std(self):
+    '''
+    Returns the standard deviation of every feature.
+    '''
+    return np.sqrt(self.variance())
+
+  #----------------------------------------------------------------------------
+  def normalize(self, X, out=None):
+    '''
+    Returns (X - mean) / std.  Features with no spread are only centred, so
+    they become 0 rather than nan.  Pass out = X to normalize in place.
+    '''
+    SD = self.std()
+    SD[SD == 0] = 1.0
+    out = np.subtract(X, self.mean, out = out)
+    return np.divide(out, SD, out = out)
+
+  #----------------------------------------------------------------------------
+  def toDict(self):
+    '''
+    Returns the stats as a dict of lists which json can save.
+    '''
+    return {'count': self.count, 'mean': self.mean.tolist(),
+            'M2': self.M2.tolist()}
+
+  #----------------------------------------------------------------------------
+  @staticmethod
+  def fromDict(d):
+    '''
+    Returns a RunningStats made from the output of toDict().
+    '''
+    stats = RunningStats()
+    stats.count = d['count']
+    stats.mean = np.array(d['mean'])
+    stats.M2 = np.array(d['M2'])
+    return stats
+
+#------------------------------------------------------------------------------
+def fixedPointType(wordWidth):
+  '''
+  Returns the smallest signed integer np.dtype with at least wordWidth bits.
+  '''
+  for dtype in (np.int8, np.int16, np.int32, np.int64):
+    if wordWidth <= 8*np.dtype(dtype).itemsize:
+      return np.dtype(dtype)
+  raise AssertionError('wordWidth can be at most 64 bits')
+
+#------------------------------------------------------------------------------
+def fracBitsFor(maxAbs, wordWidth):
+  '''
+  Returns the most fractional bits a signed wordWidth bit fixed point number
+  can have while still holding values up to maxAbs.
+  '''
+  intBits = 0
+  if maxAbs >= 1:
+    intBits = int(np.floor(np.log2(maxAbs))) + 1
+  return wordWidth - 1 - intBits
+
+#------------------------------------------------------------------------------
+def toFixedPoint(X, wordWidth, fracBits, out=None):
+  '''
+  Returns X as signed fixed point integers with fracBits fractional bits,
+  rounded to nearest and saturated to wordWidth bits.
+  '''
+  limit = 2**(wordWidth - 1)
+  scaled = np.multiply(X, 2.0**fracBits, dtype = np.float64)
+  np.rint(scaled, out = scaled)
+  np.clip(scaled, -limit, limit - 1, out = scaled)
+  if out is None:
+    return scaled.astype(fixedPointType(wordWidth))
+  out[...] = scaled
+  return out
+
+#------------------------------------------------------------------------------
+def fromFixedPoint(Q, fracBits):
+  '''
+  Returns the fixed point integers Q with fracBits fractional bits as floats.
+  '''
+  return np.multiply(Q, 2.0**-fracBits)
+
+#------------------------------------------------------------------------------
+def _isNumber(text):
+  '''
+  Returns True if the string text can be read as a float.
+  '''
+  try:
+    float(text)
+  except ValueError:
+    return False
+  return True
+
+#------------------------------------------------------------------------------
+def _toStr(text):
+  '''
+  json gives back unicode; the rest of DataMiner works with str.
+  '''
+  if isinstance(text, unicode):
+    return text.encode('utf-8')
+  return text
 
 #Unit Tests
 #==============================================================================
 #@todo Learn about unit tests and put them here...
-miner = DataMiner('iris.data')
-miner.mineData()
-miner.normalizeData()
-miner.shuffleData()
-miner.saveData()
+if __name__ == '__main__':
+  miner = DataMiner('iris.data')
+  miner.mineData()
+  miner.normalizeData()
+  miner.shuffleData()
+  miner.saveData()
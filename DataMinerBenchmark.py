@@ -0,0 +1,157 @@
+#DataMinerBenchmark.py
+import numpy as np
+import argparse
+import json
+import os
+import platform
+import resource
+import sys
+import time
+
+from DataMiner import DataMiner
+
+#Stages timed for every data set, in the order they are run
+STAGES = ('mineData', 'normalizeData', 'shuffleData', 'saveData', 'loadData',
+          'getTrainData', 'getTestData', 'getValidationData')
+
+#==============================================================================
+#------------------------------------------------------------------------------
+def generateCsv(fileName, numRows, numFeatures=4, numClasses=3, seed=0,
+                chunkSize=100000):
+  '''
+  Writes an iris shaped csv file: a header of feature names and 'class',
+  then numRows rows of numFeatures values and a class name.  The features
+  of each class are normally distributed around a different centre, like
+  the measurements of the iris species.  The file is only written if it
+  does not already exist, since the large sizes take a while.
+  '''
+  if os.path.exists(fileName):
+    return
+  rng = np.random.RandomState(seed)
+  centres = rng.uniform(1.0, 8.0, size = [numClasses, numFeatures])
+  names = np.array(['class-%d' % j for j in range(numClasses)])
+  rowFormat = ','.join(['%.1f']*numFeatures) + ',%s\n'
+
+  with open(fileName + '.tmp', 'w') as f:
+    f.write(','.join(['feature %d' % j for j in range(numFeatures)] +
+                     ['class']) + '\n')
+    for start in range(0, numRows, chunkSize):
+      size = min(chunkSize, numRows - start)
+      labels = rng.randint(numClasses, size = size)
+      features = centres[labels] + rng.normal(0.0, 0.5,
+                                              size = [size, numFeatures])
+      f.writelines(rowFormat % (tuple(row) + (name,)) for row, name
+                   in zip(features.tolist(), names[labels].tolist()))
+  os.rename(fileName + '.tmp', fileName)
+  return
+
+#------------------------------------------------------------------------------
+def benchmark(fileName, marshallFile, seed=0):
+  '''
+  Runs every stage in STAGES on fileName and returns a list with a dict
+  for each: the stage name, the seconds it took, the resident memory when
+  it started and the peak resident memory while it ran (in bytes).
+  '''
+  miner = DataMiner(fileName, marshallFile)
+  calls = {'mineData': lambda: miner.mineData(useCache = False),
+           'normalizeData': miner.normalizeData,
+           'shuffleData': lambda: miner.shuffleData(seed = seed),
+           'saveData': miner.saveData,
+           'loadData': miner.loadData,
+           'getTrainData': miner.getTrainData,
+           'getTestData': miner.getTestData,
+           'getValidationData': miner.getValidationData,
+          }
+
+  results = []
+  for stage in STAGES:
+    _resetPeakMemory()
+    startMemory = _memory()['VmRSS']
+    start = time.time()
+    calls[stage]()
+    seconds = time.time() - start
+    results.append({'stage': stage, 'seconds': seconds,
+                    'startBytes': startMemory,
+                    'peakBytes': _memory()['VmHWM']})
+  return results
+
+#------------------------------------------------------------------------------
+def main(argv=None):
+  '''
+  Generates the data sets, benchmarks them and writes the results as json.
+  Run with --help for the options.
+  '''
+  parser = argparse.ArgumentParser(description = 'Benchmark DataMiner')
+  parser.add_argument('--rows', type = int, nargs = '+',
+                      default = [1000, 10000, 100000, 1000000, 10000000],
+                      help = 'numbers of rows to generate')
+  parser.add_argument('--features', type = int, default = 4)
+  parser.add_argument('--classes', type = int, default = 3)
+  parser.add_argument('--seed', type = int, default = 0)
+  parser.add_argument('--workdir', default = '.benchmark',
+                      help = 'relative directory for generated files')
+  parser.add_argument('--output', default = 'DataMinerBenchmark.json')
+  args = parser.parse_args(argv)
+
+  if not os.path.isdir(args.workdir):
+    os.makedirs(args.workdir)
+
+  records = []
+  for numRows in args.rows:
+    name = 'iris_%d_%d_%d' % (numRows, args.features, args.classes)
+    fileName = os.path.join(args.workdir, name + '.csv')
+    generateCsv(fileName, numRows, args.features, args.classes, args.seed)
+    for result in benchmark(fileName,
+                            os.path.join(args.workdir, name + '.marshalled'),
+                            args.seed):
+      result.update({'rows': numRows, 'features': args.features,
+                     'classes': args.classes})
+      records.append(result)
+
+  with open(args.output, 'w') as f:
+    json.dump({'python': platform.python_version(),
+               'numpy': np.__version__,
+               'platform': platform.platform(),
+               'results': records}, f, indent = 1)
+
+  print '%10s %18s %10s %12s' % ('rows', 'stage', 'seconds', 'peak MiB')
+  for result in records:
+    print '%10d %18s %10.4f %12.1f' % (result['rows'], result['stage'],
+                                       result['seconds'],
+                                       result['peakBytes']/2.0**20)
+  return
+
+#PRIVATE**********************************************************************
+#------------------------------------------------------------------------------
+def _memory():
+  '''
+  Returns a dict with the current (VmRSS) and peak (VmHWM) resident memory
+  of this process in bytes.  Without /proc both are the peak from
+  getrusage().
+  '''
+  try:
+    with open('/proc/self/status') as f:
+      return dict((line.split(':')[0], int(line.split()[1])*1024)
+                  for line in f if line.startswith(('VmRSS', 'VmHWM')))
+  except IOError:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform != 'darwin':
+      peak *= 1024
+    return {'VmRSS': peak, 'VmHWM': peak}
+
+#------------------------------------------------------------------------------
+def _resetPeakMemory():
+  '''
+  Resets the peak resident memory of this process to the current resident
+  memory, so the peak of each stage can be measured.  Needs Linux 4.0 or
+  later; elsewhere peaks are since the process started.
+  '''
+  try:
+    with open('/proc/self/clear_refs', 'w') as f:
+      f.write('5')
+  except IOError:
+    pass
+  return
+
+if __name__ == '__main__':
+  main()